@@ -1,17 +1,17 @@
 import asyncio
 import base64
-from collections import defaultdict, deque
+from collections import deque
+from collections.abc import Awaitable, Callable, Iterator
 from datetime import datetime
+from functools import partial
+from itertools import islice
 import json
-import os
 import random
 import re
-import ssl
+import sys
 import time
-from typing import TYPE_CHECKING
+from typing import TYPE_CHECKING, TypeVar, cast
 
-import aiofiles
-import httpx
 from nonebot import (
     get_bot,
     get_driver,
@@ -19,18 +19,28 @@ from nonebot import (
     logger,
     on_command,
     on_message,
+    on_notice,
     require,
 )
-from nonebot.adapters.onebot.v11 import GroupMessageEvent, Message, MessageSegment, PrivateMessageEvent
+from nonebot.adapters.onebot.v11 import GroupMessageEvent, Message, MessageSegment, NoticeEvent, PrivateMessageEvent
 from nonebot.adapters.onebot.v11.permission import GROUP_ADMIN, GROUP_OWNER, PRIVATE
 from nonebot.params import CommandArg
 from nonebot.permission import SUPERUSER
 from nonebot.plugin import PluginMetadata
 from nonebot.rule import Rule
-from openai import AsyncOpenAI
 
 from .config import Config, PresetConfig
+from .imagecache import ImageCache
+from .imagedownloader import ImageDownloader
+from .imageprocessor import ImageOptions, preprocess_image, warn_if_pillow_missing
+from .jsonstore import JSONStateStore
+from .llmclient import LLMClientPool
 from .mcpclient import MCPClient
+from .sqlitestore import SQLiteStore
+from .streaming import consume_stream
+from .summary import build_summary_messages, render_transcript
+from .tokenbudget import estimate_message_tokens, estimate_tools_tokens, trim_history
+from .trigger import TriggerRules
 
 require("nonebot_plugin_localstore")
 import nonebot_plugin_localstore as store
@@ -39,9 +49,16 @@ require("nonebot_plugin_apscheduler")
 from nonebot_plugin_apscheduler import scheduler
 
 if TYPE_CHECKING:
+    from openai import AsyncOpenAI
+    from openai.types import CompletionUsage
     from openai.types.chat import (
+        ChatCompletionAssistantMessageParam,
         ChatCompletionContentPartParam,
+        ChatCompletionMessage,
         ChatCompletionMessageParam,
+        ChatCompletionMessageToolCall,
+        ChatCompletionMessageToolCallParam,
+        ChatCompletionToolMessageParam,
     )
 
 __plugin_meta__ = PluginMetadata(
@@ -57,6 +74,21 @@ __plugin_meta__ = PluginMetadata(
 plugin_config = get_plugin_config(Config).llmchat
 driver = get_driver()
 tasks: set["asyncio.Task"] = set()
+# 预设名称 -> token用量统计
+usage_stats: dict[str, dict[str, int]] = {}
+llm_client_pool = LLMClientPool(plugin_config.request_timeout)
+trigger_rules = TriggerRules(plugin_config)
+image_downloader = ImageDownloader(plugin_config.image_download_concurrency)
+image_cache = ImageCache(
+    plugin_config.image_cache_size * 1024 * 1024,
+    store.get_plugin_data_dir() / "image_cache" if plugin_config.image_cache_disk else None,
+    plugin_config.image_cache_disk_size * 1024 * 1024,
+)
+sqlite_store = (
+    SQLiteStore(store.get_plugin_data_file("llmchat_state.db"), plugin_config.history_size * 2)
+    if plugin_config.state_storage == "sqlite"
+    else None
+)
 
 
 def pop_reasoning_content(
@@ -84,9 +116,15 @@ class GroupState:
         self.queue = asyncio.Queue()
         self.processing = False
         self.last_active = time.time()
-        self.past_events = deque(maxlen=plugin_config.past_events_size)
+        self.past_events: deque[PastEvent] = deque(maxlen=plugin_config.past_events_size)
         self.group_prompt: str | None = None
         self.user_prompt: str | None = None
+        # (构建参数, 系统提示词)
+        self.system_prompt: tuple[tuple, str] | None = None
+        # 被移出上下文的历史记录的摘要，以及等待总结的消息
+        self.summary: str | None = None
+        self.summary_pending: list = []
+        self.summary_task: asyncio.Task | None = None
         self.output_reasoning_content = False
         self.random_trigger_prob = plugin_config.random_trigger_prob
 
@@ -99,24 +137,113 @@ class PrivateChatState:
         self.queue = asyncio.Queue()
         self.processing = False
         self.last_active = time.time()
-        self.past_events = deque(maxlen=plugin_config.past_events_size)
+        self.past_events: deque[PastEvent] = deque(maxlen=plugin_config.past_events_size)
         self.group_prompt: str | None = None
         self.output_reasoning_content = False
+        # (构建参数, 系统提示词)
+        self.system_prompt: tuple[tuple, str] | None = None
+        # 被移出上下文的历史记录的摘要，以及等待总结的消息
+        self.summary: str | None = None
+        self.summary_pending: list = []
+        self.summary_task: asyncio.Task | None = None
+
+
+_State = TypeVar("_State", GroupState, PrivateChatState)
 
 
-group_states: dict[int, GroupState] = defaultdict(GroupState)
-private_chat_states: dict[int, PrivateChatState] = defaultdict(PrivateChatState)
+class LazyStateDict(dict[int, _State]):
+    """按需加载的状态表
+
+    启动时只加载所有上下文的设置作为索引，首次访问某个上下文前通过 load 异步读取它的历史记录并创建状态。
+    """
+
+    def __init__(self, chat_type: str, factory: Callable[[], _State], default_preset: str):
+        super().__init__()
+        self.chat_type = chat_type
+        self.factory = factory
+        self.default_preset = default_preset
+        # 已持久化但尚未加载到内存的上下文设置
+        self.unloaded: dict[int, dict] = {}
+
+    def __missing__(self, context_id: int) -> _State:
+        """只为没有保存过的上下文创建新状态，已保存的上下文需要先通过 load 加载"""
+        if context_id in self.unloaded:
+            raise KeyError(f"{self.chat_type}：{context_id} 尚未加载")
+        state = self.factory()
+        self[context_id] = state
+        return state
+
+    async def load(self, context_id: int) -> _State:
+        """获取上下文的状态，尚未加载时在事件循环之外读取历史记录"""
+        state = self.get(context_id)
+        if state is not None:
+            return state
+        if context_id not in self.unloaded:
+            return self[context_id]
+        history = await load_history(self.chat_type, context_id)
+        # 等待读取期间可能已被并发的调用方加载
+        state = self.get(context_id)
+        if state is not None:
+            return state
+        state = self.factory()
+        restore_state(state, {**self.unloaded.pop(context_id), "history": history})
+        self[context_id] = state
+        return state
+
+    def __contains__(self, context_id: object) -> bool:
+        return super().__contains__(context_id) or context_id in self.unloaded
+
+    def all_settings(self) -> dict[int, dict]:
+        """所有上下文（包括尚未加载的）的设置"""
+        return {**self.unloaded, **{context_id: dump_state_settings(state) for context_id, state in self.items()}}
+
+    def preset_name(self, context_id: int) -> str:
+        """不创建状态，获取上下文当前的预设名称"""
+        state = self.get(context_id)
+        if state is not None:
+            return state.preset_name
+        settings = self.unloaded.get(context_id)
+        return settings["preset"] if settings is not None else self.default_preset
+
+    def unload(self, context_id: int):
+        """将状态移出内存，只保留设置，历史记录应已持久化"""
+        state = self.pop(context_id)
+        self.unloaded[context_id] = dump_state_settings(state)
+
+
+group_states: LazyStateDict[GroupState] = LazyStateDict("group", GroupState, plugin_config.default_preset)
+private_chat_states: LazyStateDict[PrivateChatState] = LazyStateDict(
+    "private", PrivateChatState, plugin_config.private_chat_preset
+)
+
+
+def estimate_state_size(state: GroupState | PrivateChatState) -> int:
+    """粗略估算状态占用的内存（字节），只统计历史记录中的文本和图片，以及未处理的消息"""
+    size = 2048
+    for message in state.history:
+        content = message.get("content")
+        if isinstance(content, str):
+            size += len(content)
+        elif isinstance(content, list):
+            for part in content:
+                if part.get("type") == "text":
+                    size += len(part["text"])
+                elif part.get("type") == "image_url":
+                    size += len(part["image_url"]["url"])
+    for record in state.past_events:
+        size += 128 + len(record.text)
+    if state.summary:
+        size += len(state.summary)
+    return size
 
 
 # 获取当前预设配置
 def get_preset(context_id: int, is_group: bool = True) -> PresetConfig:
-    if is_group:
-        state = group_states[context_id]
-    else:
-        state = private_chat_states[context_id]
+    states = group_states if is_group else private_chat_states
+    preset_name = states.preset_name(context_id)
 
     for preset in plugin_config.api_presets:
-        if preset.name == state.preset_name:
+        if preset.name == preset_name:
             return preset
     return plugin_config.api_presets[0]  # 默认返回第一个预设
 
@@ -161,6 +288,22 @@ def format_message(event: GroupMessageEvent | PrivateMessageEvent) -> str:
     return json.dumps(message, ensure_ascii=False)
 
 
+class PastEvent:
+    """机器人错过的一条消息，在收到消息时就格式化好，不持有完整的OneBot事件"""
+
+    __slots__ = ("images", "text")
+
+    def __init__(self, text: str, images: tuple[tuple[str, str], ...]):
+        # format_message 的结果
+        self.text = text
+        # (缓存键, 下载地址)，按消息段顺序排列
+        self.images = images
+
+    @classmethod
+    def from_event(cls, event: GroupMessageEvent | PrivateMessageEvent) -> "PastEvent":
+        return cls(format_message(event), extract_images(event))
+
+
 def build_reasoning_forward_nodes(self_id: str, reasoning_content: str):
     self_nickname = next(iter(driver.config.nickname))
     nodes = [
@@ -189,9 +332,8 @@ async def is_triggered(event: GroupMessageEvent | PrivateMessageEvent) -> bool:
     """扩展后的消息处理规则"""
 
     if isinstance(event, GroupMessageEvent):
-        state = group_states[event.group_id]
-
-        if state.preset_name == "off":
+        # 关闭的群不创建状态
+        if group_states.preset_name(event.group_id) == "off":
             return False
 
         # 黑名单用户
@@ -199,17 +341,27 @@ async def is_triggered(event: GroupMessageEvent | PrivateMessageEvent) -> bool:
             return False
 
         # 忽略特定前缀的消息
+        rule = trigger_rules.for_group(event.group_id)
         msg_text = event.get_plaintext().strip()
-        for prefix in plugin_config.ignore_prefixes:
-            if msg_text.startswith(prefix):
-                return False
+        if rule.is_ignored(msg_text):
+            return False
 
-        state.past_events.append(event)
+        state = await group_states.load(event.group_id)
+        state.last_active = time.time()
+        state.past_events.append(PastEvent.from_event(event))
 
         # 原有@触发条件
         if event.is_tome():
             return True
 
+        # 回复机器人的消息
+        if event.reply is not None and event.reply.sender.user_id == event.self_id:
+            return True
+
+        # 关键词、别名和正则触发条件
+        if rule.matches(msg_text):
+            return True
+
         # 随机触发条件
         if random.random() < state.random_trigger_prob:
             return True
@@ -221,9 +373,7 @@ async def is_triggered(event: GroupMessageEvent | PrivateMessageEvent) -> bool:
         if not plugin_config.enable_private_chat:
             return False
 
-        state = private_chat_states[event.user_id]
-
-        if state.preset_name == "off":
+        if private_chat_states.preset_name(event.user_id) == "off":
             return False
 
         # 黑名单用户
@@ -231,12 +381,12 @@ async def is_triggered(event: GroupMessageEvent | PrivateMessageEvent) -> bool:
             return False
 
         # 忽略特定前缀的消息
-        msg_text = event.get_plaintext().strip()
-        for prefix in plugin_config.ignore_prefixes:
-            if msg_text.startswith(prefix):
-                return False
+        if trigger_rules.default.is_ignored(event.get_plaintext().strip()):
+            return False
 
-        state.past_events.append(event)
+        state = await private_chat_states.load(event.user_id)
+        state.last_active = time.time()
+        state.past_events.append(PastEvent.from_event(event))
 
         # 私聊默认触发
         return True
@@ -259,17 +409,18 @@ async def handle_message(event: GroupMessageEvent | PrivateMessageEvent):
         logger.debug(
             f"收到群聊消息 群号：{group_id} 用户：{event.user_id} 内容：{event.get_plaintext()}"
         )
-        state = group_states[group_id]
+        state = await group_states.load(group_id)
         context_id = group_id
     else:  # PrivateMessageEvent
         user_id = event.user_id
         logger.debug(
             f"收到私聊消息 用户：{user_id} 内容：{event.get_plaintext()}"
         )
-        state = private_chat_states[user_id]
+        state = await private_chat_states.load(user_id)
         context_id = user_id
 
-    await state.queue.put(event)
+    # 同时记录入队时间，合并连续触发时从第一次触发开始计算最长等待时间
+    await state.queue.put((asyncio.get_running_loop().time(), event))
     if not state.processing:
         state.processing = True
         is_group = isinstance(event, GroupMessageEvent)
@@ -277,32 +428,140 @@ async def handle_message(event: GroupMessageEvent | PrivateMessageEvent):
         task.add_done_callback(tasks.discard)
         tasks.add(task)
 
-async def process_images(event: GroupMessageEvent | PrivateMessageEvent) -> list[str]:
-    base64_images = []
+def extract_images(event: GroupMessageEvent | PrivateMessageEvent) -> tuple[tuple[str, str], ...]:
+    """按消息段顺序提取图片，返回(缓存键, 下载地址)列表，缓存键优先使用OneBot的file字段"""
+    images = []
     for segement in event.get_message():
         if segement.type == "image":
             image_url = segement.data.get("url") or segement.data.get("file")
             if image_url:
-                try:
-                    # 处理高版本 httpx 的 [SSL: SSLV3_ALERT_HANDSHAKE_FAILURE] 报错
-                    ssl_context = ssl.create_default_context()
-                    ssl_context.check_hostname = False
-                    ssl_context.verify_mode = ssl.CERT_NONE
-                    ssl_context.set_ciphers("DEFAULT@SECLEVEL=2")
-
-                    # 下载图片并将图片转换为base64
-                    async with httpx.AsyncClient(verify=ssl_context) as client:
-                        response = await client.get(image_url, timeout=10.0)
-                        if response.status_code != 200:
-                            logger.error(f"下载图片失败: {image_url}, 状态码: {response.status_code}")
-                            continue
-                        image_data = response.content
-                        base64_data = base64.b64encode(image_data).decode("utf-8")
-                        base64_images.append(base64_data)
-                except Exception as e:
-                    logger.error(f"处理图片时出错: {e}")
-    logger.debug(f"共处理 {len(base64_images)} 张图片")
-    return base64_images
+                images.append((segement.data.get("file") or image_url, image_url))
+    return tuple(images)
+
+
+async def encode_image(key: str, image_data: bytes, options: ImageOptions) -> str:
+    """计算内容哈希并预处理图片，相同内容只编码一次，CPU密集部分在线程池中执行"""
+    content_hash = await asyncio.to_thread(ImageCache.content_hash, image_data)
+    encoded = image_cache.get_by_hash(key, content_hash, options)
+    if encoded is None:
+        encoded = await asyncio.to_thread(preprocess_image, image_data, options)
+        image_cache.put(key, content_hash, options, encoded)
+    return encoded
+
+
+async def process_images(
+    images_per_event: list[tuple[tuple[str, str], ...]], preset: PresetConfig
+) -> list[list[tuple[str, str]]]:
+    """并发下载并预处理多条消息中的图片，按消息和消息段顺序返回(缓存键, data url)，处理失败的图片会被跳过"""
+    options = ImageOptions(
+        preset.image_max_edge,
+        preset.image_max_pixels,
+        preset.image_format,
+        preset.image_quality,
+    )
+
+    # 先查内存缓存，同一请求中重复的图片只处理一次
+    encoded_images: dict[str, str | None] = {}
+    missing_images: dict[str, str] = {}
+    for images in images_per_event:
+        for key, url in images:
+            if key in encoded_images or key in missing_images:
+                continue
+            cached = image_cache.get(key, options)
+            if cached is None:
+                missing_images[key] = url
+            else:
+                encoded_images[key] = cached
+
+    if missing_images:
+        # 再查磁盘缓存，仍未命中的图片并发下载
+        keys = list(missing_images)
+        disk_datas = await asyncio.gather(*(image_cache.load_from_disk(key) for key in keys))
+        image_datas = dict(zip(keys, disk_datas))
+        download_keys = [key for key in keys if image_datas[key] is None]
+        downloaded = await image_downloader.fetch_all([missing_images[key] for key in download_keys])
+        image_datas.update(zip(download_keys, downloaded))
+        await asyncio.gather(
+            *(
+                image_cache.save_to_disk(key, image_data)
+                for key, image_data in zip(download_keys, downloaded)
+                if image_data is not None
+            )
+        )
+        valid_images = [(key, image_data) for key, image_data in image_datas.items() if image_data is not None]
+        encoded_list = await asyncio.gather(
+            *(encode_image(key, image_data, options) for key, image_data in valid_images)
+        )
+        encoded_images.update(dict.fromkeys(keys))
+        encoded_images.update(zip((key for key, _ in valid_images), encoded_list))
+
+    image_urls_per_event: list[list[tuple[str, str]]] = []
+    for images in images_per_event:
+        image_urls = []
+        for key, _ in images:
+            encoded = encoded_images[key]
+            if encoded is not None:
+                image_urls.append((key, encoded))
+        image_urls_per_event.append(image_urls)
+
+    logger.debug(f"共处理 {sum(len(images) for images in image_urls_per_event)} 张图片")
+    return image_urls_per_event
+
+
+# 历史记录中没有重新附上的图片
+IMAGE_PLACEHOLDER = {"type": "text", "text": "[图片]"}
+
+
+def history_image_parts(history: list["ChatCompletionMessageParam"]) -> Iterator[tuple[int, int, dict]]:
+    """按从新到旧的顺序列出历史记录中的图片，返回(消息序号, 消息段序号, 消息段)"""
+    for i in range(len(history) - 1, -1, -1):
+        content = history[i].get("content")
+        if history[i]["role"] != "user" or not isinstance(content, list):
+            continue
+        for j in range(len(content) - 1, -1, -1):
+            part = cast("dict", content[j])
+            if part.get("type") in ("image_ref", "image_url"):
+                yield i, j, part
+
+
+def select_history_images(history: list["ChatCompletionMessageParam"], keep: int) -> tuple[tuple[str, str], ...]:
+    """历史记录中最近keep张图片中需要重新处理的图片引用"""
+    return tuple(
+        (part["image_ref"]["key"], part["image_ref"]["url"])
+        for _, _, part in islice(history_image_parts(history), keep)
+        if part["type"] == "image_ref"
+    )
+
+
+def restore_history_images(
+    history: list["ChatCompletionMessageParam"], keep: int, encoded_images: dict[str, str]
+) -> list["ChatCompletionMessageParam"]:
+    """最近keep张图片换回data url，其余图片换成占位符，只复制有变化的消息"""
+    replacements: dict[int, dict[int, dict]] = {}
+    for count, (i, j, part) in enumerate(history_image_parts(history)):
+        if part["type"] == "image_ref":
+            data_url = encoded_images.get(part["image_ref"]["key"]) if count < keep else None
+            new_part = {"type": "image_url", "image_url": {"url": data_url}} if data_url else IMAGE_PLACEHOLDER
+        elif count < keep:
+            # 旧版本保存在历史记录中的data url，直接使用
+            continue
+        else:
+            new_part = IMAGE_PLACEHOLDER
+        replacements.setdefault(i, {})[j] = new_part
+    if not replacements:
+        return history
+
+    history = list(history)
+    for i, parts in replacements.items():
+        message_content = history[i].get("content")
+        if not isinstance(message_content, list):
+            continue
+        content: list = list(message_content)
+        for j, new_part in parts.items():
+            content[j] = new_part
+        history[i] = cast("ChatCompletionMessageParam", {**history[i], "content": content})
+    return history
+
 
 async def send_split_messages(message_handler, content: str):
     """
@@ -318,31 +577,354 @@ async def send_split_messages(message_handler, content: str):
         logger.debug(f"发送消息分段 内容：{segment[:50]}...")  # 只记录前50个字符避免日志过大
         await message_handler.send(Message(segment))
 
+
+def create_segment_sender(message_handler) -> Callable[[str], Awaitable[None]]:
+    """
+    创建流式回复的分段发送函数，第一段立即发送，之后每段间隔与send_split_messages一致
+    """
+    last_sent = 0.0
+
+    async def send_segment(segment: str):
+        nonlocal last_sent
+        # 跳过空消息
+        segment = segment.strip()
+        if not segment:
+            return
+        wait_time = 2 - (time.monotonic() - last_sent)
+        if wait_time > 0:
+            await asyncio.sleep(wait_time)  # 避免发送过快
+        logger.debug(f"发送流式消息分段 内容：{segment[:50]}...")
+        await message_handler.send(Message(segment))
+        last_sent = time.monotonic()
+
+    return send_segment
+
+
+async def send_reasoning_forward(self_id: str, is_group: bool, context_id: int, reasoning_content: str):
+    """以合并转发的形式发送思维过程"""
+    try:
+        bot = get_bot(self_id)
+        if is_group:
+            await bot.send_group_forward_msg(
+                group_id=context_id,
+                messages=build_reasoning_forward_nodes(
+                    bot.self_id, reasoning_content
+                ),
+            )
+        else:
+            await bot.send_private_forward_msg(
+                user_id=context_id,
+                messages=build_reasoning_forward_nodes(
+                    bot.self_id, reasoning_content
+                ),
+            )
+    except Exception as e:
+        logger.error(f"合并转发消息发送失败：\n{e!s}\n")
+
+
+def build_system_prompt(is_group: bool, default_prompt: str, tool_prompt_servers: tuple[str, ...] | None) -> str:
+    """构建系统提示词"""
+    chat_type = "群聊" if is_group else "私聊"
+    # nickname是集合，排序后重启前后的提示词也保持一致
+    bot_names = "、".join(sorted(driver.config.nickname))
+
+    # 分成多行以满足行长限制
+    system_lines = [
+        f"我想要你帮我在{chat_type}中闲聊，大家一般叫你{bot_names}。",
+        "我将会在后面的信息中告诉你每条信息的发送者和发送时间，你可以直接称呼发送者为他对应的昵称。",
+        "你的回复需要遵守以下几点规则：",
+        "- 你可以使用多条消息回复，每两条消息之间使用<botbr>分隔，<botbr>前后不需要包含额外的换行和空格。",
+        "- 除<botbr>外，消息中不应该包含其他类似的标记。",
+        "- 不要使用markdown或者html，聊天软件不支持解析，换行请用换行符。",
+        "- 你应该以普通人的方式发送消息，每条消息字数要尽量少一些，应该倾向于使用更多条的消息回复。",
+        "- 代码则不需要分段，用单独的一条消息发送。",
+        "- 请使用发送者的昵称称呼发送者，你可以礼貌地问候发送者，但只需要在"
+        "第一次回答这位发送者的问题时问候他。",
+        "- 你有引用某条消息的能力，使用[CQ:reply,id=（消息id）]来引用。",
+        "- 如果有多条消息，你应该优先回复提到你的，一段时间之前的就不要回复了，也可以直接选择不回复。",
+        "- 如果你选择完全不回复，你只需要直接输出一个<botbr>。",
+        "- 如果你需要思考的话，你应该尽量少思考，以节省时间。",
+    ]
+
+    if is_group:
+        system_lines += [
+            "- 你有at群成员的能力，只需要在某条消息中插入[CQ:at,qq=（QQ号）]，"
+            "也就是CQ码。at发送者是非必要的，你可以根据你自己的想法at某个人。",
+        ]
+
+    system_lines += [
+        "下面是关于你性格的设定，如果设定中提到让你扮演某个人，或者设定中有提到名字，则优先使用设定中的名字。",
+        default_prompt,
+    ]
+
+    systemPrompt = "\n".join(system_lines)
+    if tool_prompt_servers is not None:
+        systemPrompt += "\n你也可以使用一些工具，下面是关于这些工具的额外说明：\n"
+        for mcp_name in tool_prompt_servers:
+            systemPrompt += f"{mcp_name}：{plugin_config.mcp_servers[mcp_name].additional_prompt}"
+            systemPrompt += "\n"
+    return systemPrompt
+
+
+def get_system_prompt(
+    state: GroupState | PrivateChatState, is_group: bool, preset: PresetConfig, mcp_client: MCPClient
+) -> str:
+    """获取系统提示词，只在群聊提示词、预设或可用的MCP服务器变化时重新构建
+
+    同一上下文在这些条件不变时发送的系统提示词逐字节相同，便于命中API提供方的前缀缓存。
+    """
+    default_prompt = (state.group_prompt) or plugin_config.default_prompt
+    tool_prompt_servers = None
+    if preset.support_mcp:
+        # 熔断中的服务器不提供工具，也不需要它的说明
+        tool_prompt_servers = tuple(
+            mcp_name
+            for mcp_name, mcp_config in plugin_config.mcp_servers.items()
+            if mcp_config.additional_prompt and mcp_client.is_server_available(mcp_name)
+        )
+    key = (preset.name, default_prompt, tool_prompt_servers)
+    if state.system_prompt is not None and state.system_prompt[0] == key:
+        return state.system_prompt[1]
+
+    systemPrompt = build_system_prompt(is_group, default_prompt, tool_prompt_servers)
+    logger.debug(f"构建系统提示词：\n{systemPrompt}")
+    state.system_prompt = (key, systemPrompt)
+    return systemPrompt
+
+
+def get_cached_tokens(usage: "CompletionUsage") -> int:
+    """读取命中提供方前缀缓存的输入token数"""
+    if usage.prompt_tokens_details is not None and usage.prompt_tokens_details.cached_tokens:
+        return usage.prompt_tokens_details.cached_tokens
+    # DeepSeek等提供方使用单独的字段
+    return getattr(usage, "prompt_cache_hit_tokens", None) or 0
+
+
+def record_usage(preset: PresetConfig, usage: "CompletionUsage"):
+    """按预设累计token用量"""
+    stats = usage_stats.setdefault(
+        preset.name, {"requests": 0, "prompt_tokens": 0, "cached_tokens": 0, "completion_tokens": 0}
+    )
+    cached_tokens = get_cached_tokens(usage)
+    stats["requests"] += 1
+    stats["prompt_tokens"] += usage.prompt_tokens
+    stats["cached_tokens"] += cached_tokens
+    stats["completion_tokens"] += usage.completion_tokens
+    logger.debug(
+        f"收到API响应 使用token数：{usage.total_tokens} 输入：{usage.prompt_tokens} 缓存命中：{cached_tokens}"
+    )
+
+
+async def create_chat_completion(
+    client: "AsyncOpenAI",
+    preset: PresetConfig,
+    client_config: dict,
+    messages: list["ChatCompletionMessageParam"],
+    on_segment: Callable[[str], Awaitable[None]],
+    on_reasoning: Callable[[str], Awaitable[None]] | None,
+) -> tuple["ChatCompletionMessage | None", "CompletionUsage | None"]:
+    """
+    请求LLM，流式模式下每个<botbr>分段闭合后立即通过on_segment发送
+    """
+    if not preset.stream:
+        response = await client.chat.completions.create(**client_config, messages=messages)
+        message, usage = response.choices[0].message, response.usage
+    else:
+        stream = await client.chat.completions.create(
+            **client_config,
+            messages=messages,
+            stream=True,
+            stream_options={"include_usage": True},
+        )
+        message, usage = await consume_stream(stream, on_segment, on_reasoning)
+
+    if usage is not None:
+        record_usage(preset, usage)
+    return message, usage
+
+
+def digest_tool_results(messages: list["ChatCompletionMessageParam"]) -> list["ChatCompletionMessageParam"]:
+    """保存到历史记录前，将过长的工具结果缩短为开头部分，之后的请求不再重复发送完整结果"""
+    max_length = plugin_config.tool_result_history_length
+    if max_length <= 0:
+        return messages
+    digested: list[ChatCompletionMessageParam] = []
+    for message in messages:
+        if message["role"] == "tool" and isinstance(message["content"], str) and len(message["content"]) > max_length:
+            content = message["content"]
+            tool_message: ChatCompletionToolMessageParam = {
+                "role": "tool",
+                "tool_call_id": message["tool_call_id"],
+                "content": f"{content[:max_length]}\n（之前的工具结果，已省略{len(content) - max_length}字符）",
+            }
+            message = tool_message
+        digested.append(message)
+    return digested
+
+
+async def execute_tool_calls(
+    mcp_client: MCPClient,
+    tool_calls: list["ChatCompletionMessageToolCall"],
+    bot_id: str,
+    group_id: int | None = None,
+) -> list["ChatCompletionMessageParam"]:
+    """
+    并发执行同一轮中的多个工具调用，结果按tool_calls的顺序返回
+    """
+    semaphore = asyncio.Semaphore(plugin_config.tool_call_concurrency)
+    # 不允许并发的MCP服务器，同一时间只执行一个调用
+    serial_locks: dict[str, asyncio.Lock] = {}
+
+    async def call_tool(tool_name: str, tool_args: dict):
+        server_name = mcp_client.get_serial_server(tool_name)
+        if server_name is None:
+            async with semaphore:
+                return await mcp_client.call_tool(tool_name, tool_args, group_id=group_id, bot_id=bot_id)
+        # 先排队等待同一服务器的调用完成，再占用并发名额
+        async with serial_locks.setdefault(server_name, asyncio.Lock()), semaphore:
+            return await mcp_client.call_tool(tool_name, tool_args, group_id=group_id, bot_id=bot_id)
+
+    results: list[str] = [""] * len(tool_calls)
+
+    async def run_tool_call(index: int, tool_name: str, tool_args: dict):
+        # 单个调用失败时把错误作为结果返回，保证每个tool_call_id都有对应的工具消息
+        try:
+            result = str(await call_tool(tool_name, tool_args))
+        except Exception as e:
+            logger.error(f"调用工具{tool_name}失败: {e!s}")
+            results[index] = f"调用工具{tool_name}失败: {e!s}"
+            return
+        max_length = mcp_client.get_result_max_length(tool_name, plugin_config.tool_result_max_length)
+        if 0 < max_length < len(result):
+            logger.debug(f"工具{tool_name}的结果过长（{len(result)}字符），截断到{max_length}字符")
+            result = f"{result[:max_length]}\n（结果过长，已截断，完整结果共{len(result)}字符）"
+        results[index] = result
+
+    pending_calls = []
+    for index, tool_call in enumerate(tool_calls):
+        logger.debug(f"处理工具调用：{tool_call.function.name} 参数：{tool_call.function.arguments}")
+
+        tool_name = tool_call.function.name
+        try:
+            tool_args = json.loads(tool_call.function.arguments)
+        except (json.JSONDecodeError, TypeError, ValueError) as e:
+            error_message = (
+                f"工具调用参数格式错误，无法解析 {tool_name} 的 arguments: {e!s}. "
+                f"原始参数: {tool_call.function.arguments}"
+            )
+            logger.warning(error_message)
+            results[index] = error_message
+            continue
+
+        # 发送工具调用提示
+        await handler.send(Message(f"正在使用{mcp_client.get_friendly_name(tool_name)}"))
+        pending_calls.append(run_tool_call(index, tool_name, tool_args))
+
+    if len(pending_calls) > 1:
+        logger.debug(f"并发执行{len(pending_calls)}个工具调用")
+    await asyncio.gather(*pending_calls)
+
+    return [
+        {
+            "role": "tool",
+            "tool_call_id": tool_call.id,
+            "content": result,
+        }
+        for tool_call, result in zip(tool_calls, results)
+    ]
+
+
+def schedule_summary(
+    context_id: int, is_group: bool, state: GroupState | PrivateChatState, messages: list["ChatCompletionMessageParam"]
+):
+    """将被移出上下文的消息加入待总结列表，在后台合并进摘要，不阻塞回复"""
+    # 总结一直失败时只保留最近的消息，避免无限增长
+    state.summary_pending = [*state.summary_pending, *messages][-plugin_config.history_size * 2 :]
+    if state.summary_task is not None:
+        return
+    state.summary_task = asyncio.create_task(summarize_history(context_id, is_group, state))
+    state.summary_task.add_done_callback(tasks.discard)
+    tasks.add(state.summary_task)
+
+
+async def summarize_history(context_id: int, is_group: bool, state: GroupState | PrivateChatState):
+    """把待总结的消息合并进摘要"""
+    try:
+        preset = next(
+            (preset for preset in plugin_config.api_presets if preset.name == plugin_config.summary_preset), None
+        )
+        if preset is None:
+            logger.warning(f"总结历史记录的预设不存在：{plugin_config.summary_preset}")
+            state.summary_pending = []
+            return
+        client = await llm_client_pool.get_client(preset)
+        while state.summary_pending:
+            pending = state.summary_pending
+            state.summary_pending = []
+            try:
+                response = await client.chat.completions.create(
+                    model=preset.model_name,
+                    max_tokens=preset.max_tokens,
+                    temperature=preset.temperature,
+                    timeout=60,
+                    extra_body=preset.extra_body,
+                    messages=cast(
+                        "list[ChatCompletionMessageParam]",
+                        build_summary_messages(state.summary, render_transcript(pending), plugin_config.summary_max_length),
+                    ),
+                )
+            except Exception as e:
+                logger.opt(exception=e).warning(f"总结历史记录失败 {'群号' if is_group else '用户'}：{context_id}")
+                # 下次有消息被移出时重试
+                state.summary_pending = [*pending, *state.summary_pending][-plugin_config.history_size * 2 :]
+                return
+            if response.usage is not None:
+                record_usage(preset, response.usage)
+            summary, _ = pop_reasoning_content(response.choices[0].message.content)
+            if summary and summary.strip():
+                state.summary = summary.strip()
+                logger.debug(f"更新历史记录摘要 {'群号' if is_group else '用户'}：{context_id}\n{state.summary}")
+                await persist_settings(context_id, is_group)
+    except Exception as e:
+        # 获取客户端等失败时保留待总结的消息，下次有消息被移出时重试
+        logger.opt(exception=e).warning(f"总结历史记录失败 {'群号' if is_group else '用户'}：{context_id}")
+    finally:
+        if state.summary_task is asyncio.current_task():
+            state.summary_task = None
+
+
+async def wait_for_burst(
+    state: GroupState | PrivateChatState, event: GroupMessageEvent | PrivateMessageEvent, enqueued_at: float
+) -> GroupMessageEvent | PrivateMessageEvent:
+    """等待连续的触发，每次新的触发都会重新计时，从第一次触发入队开始总等待时间不超过coalesce_max_wait，返回最后一次触发的事件"""
+    loop = asyncio.get_running_loop()
+    deadline = enqueued_at + plugin_config.coalesce_max_wait
+    merged = 0
+    while (timeout := min(plugin_config.coalesce_window, deadline - loop.time())) > 0:
+        try:
+            _, event = await asyncio.wait_for(state.queue.get(), timeout)
+        except asyncio.TimeoutError:
+            break
+        state.queue.task_done()
+        merged += 1
+    if merged:
+        logger.debug(f"合并了{merged}次连续触发")
+    return event
+
+
 async def process_messages(context_id: int, is_group: bool = True):
     if is_group:
         group_id = context_id
-        state = group_states[group_id]
+        state = await group_states.load(group_id)
     else:
         user_id = context_id
-        state = private_chat_states[user_id]
+        state = await private_chat_states.load(user_id)
         group_id = None
 
     preset = get_preset(context_id, is_group)
 
-    # 初始化OpenAI客户端
-    if preset.proxy != "":
-        client = AsyncOpenAI(
-            base_url=preset.api_base,
-            api_key=preset.api_key,
-            timeout=plugin_config.request_timeout,
-            http_client=httpx.AsyncClient(proxy=preset.proxy),
-        )
-    else:
-        client = AsyncOpenAI(
-            base_url=preset.api_base,
-            api_key=preset.api_key,
-            timeout=plugin_config.request_timeout,
-        )
+    # 获取复用的OpenAI客户端
+    client = await llm_client_pool.get_client(preset)
 
     chat_type = "群聊" if is_group else "私聊"
     context_type = "群号" if is_group else "用户"
@@ -351,65 +933,32 @@ async def process_messages(context_id: int, is_group: bool = True):
     )
     try:
         while not state.queue.empty():
-            event = await state.queue.get()
+            enqueued_at, event = await state.queue.get()
+            # 短时间内的连续触发合并成一次请求
+            if plugin_config.coalesce_window > 0:
+                event = await wait_for_burst(state, event, enqueued_at)
             if is_group:
                 logger.debug(f"从队列获取消息 群号：{context_id} 消息ID：{event.message_id}")
                 group_id = context_id
             else:
                 logger.debug(f"从队列获取消息 用户：{context_id} 消息ID：{event.message_id}")
                 group_id = None
-            past_events_snapshot = []
+            past_events_snapshot: list[PastEvent] = []
             mcp_client = MCPClient.get_instance(
                 plugin_config.mcp_servers,
                 plugin_config.mcp_server_cwd,
+                plugin_config.onebot_cache_ttl,
             )
             try:
-                # 构建系统提示，分成多行以满足行长限制
-                chat_type = "群聊" if is_group else "私聊"
-                bot_names = "、".join(list(driver.config.nickname))
-                default_prompt = (state.group_prompt) or plugin_config.default_prompt
-
-                system_lines = [
-                    f"我想要你帮我在{chat_type}中闲聊，大家一般叫你{bot_names}。",
-                    "我将会在后面的信息中告诉你每条信息的发送者和发送时间，你可以直接称呼发送者为他对应的昵称。",
-                    "你的回复需要遵守以下几点规则：",
-                    "- 你可以使用多条消息回复，每两条消息之间使用<botbr>分隔，<botbr>前后不需要包含额外的换行和空格。",
-                    "- 除<botbr>外，消息中不应该包含其他类似的标记。",
-                    "- 不要使用markdown或者html，聊天软件不支持解析，换行请用换行符。",
-                    "- 你应该以普通人的方式发送消息，每条消息字数要尽量少一些，应该倾向于使用更多条的消息回复。",
-                    "- 代码则不需要分段，用单独的一条消息发送。",
-                    "- 请使用发送者的昵称称呼发送者，你可以礼貌地问候发送者，但只需要在"
-                    "第一次回答这位发送者的问题时问候他。",
-                    "- 你有引用某条消息的能力，使用[CQ:reply,id=（消息id）]来引用。",
-                    "- 如果有多条消息，你应该优先回复提到你的，一段时间之前的就不要回复了，也可以直接选择不回复。",
-                    "- 如果你选择完全不回复，你只需要直接输出一个<botbr>。",
-                    "- 如果你需要思考的话，你应该尽量少思考，以节省时间。",
-                ]
-
-                if is_group:
-                    system_lines += [
-                        "- 你有at群成员的能力，只需要在某条消息中插入[CQ:at,qq=（QQ号）]，"
-                        "也就是CQ码。at发送者是非必要的，你可以根据你自己的想法at某个人。",
-                    ]
-
-                system_lines += [
-                    "下面是关于你性格的设定，如果设定中提到让你扮演某个人，或者设定中有提到名字，则优先使用设定中的名字。",
-                    default_prompt,
-                ]
-
-                systemPrompt = "\n".join(system_lines)
-                if preset.support_mcp:
-                    systemPrompt += "\n你也可以使用一些工具，下面是关于这些工具的额外说明：\n"
-                    for mcp_name, mcp_config in plugin_config.mcp_servers.items():
-                        if mcp_config.additional_prompt:
-                            systemPrompt += f"{mcp_name}：{mcp_config.additional_prompt}"
-                            systemPrompt += "\n"
-
-                logger.debug(f"构建系统提示词：\n{systemPrompt}")
+                systemPrompt = get_system_prompt(state, is_group, preset, mcp_client)
 
                 messages: list[ChatCompletionMessageParam] = [
                     {"role": "system", "content": systemPrompt}
                 ]
+                # 更早的对话的摘要放在系统提示词之后，不影响系统提示词的前缀缓存
+                if state.summary:
+                    messages.append({"role": "system", "content": f"以下是更早的对话的摘要：\n{state.summary}"})
+                head_size = len(messages)
 
                 while len(state.history) > 0 and state.history[0]["role"] != "user":
                     state.history.popleft()
@@ -421,19 +970,39 @@ async def process_messages(context_id: int, is_group: bool = True):
                     break
 
                 content: list[ChatCompletionContentPartParam] = []
+                # 保存到历史记录的内容，图片只保存引用，不保存base64
+                stored_content: list[dict] = []
 
                 # 将机器人错过的消息推送给LLM
                 past_events_snapshot = list(state.past_events)
                 state.past_events.clear()
-                for ev in past_events_snapshot:
-                    text_content = format_message(ev)
-                    content.append({"type": "text", "text": text_content})
+                # 准备请求期间到达的触发，它们的消息已经包含在本次请求中
+                while not state.queue.empty():
+                    _, event = state.queue.get_nowait()
+                    state.queue.task_done()
+
+                # 将消息中的图片转成 base64，所有消息和需要重新附上的历史图片一起并发下载
+                history_images_keep = preset.history_images if preset.support_image else 0
+                if preset.support_image:
+                    history_images = select_history_images(messages[head_size:], history_images_keep)
+                    history_encoded, *image_urls_per_event = await process_images(
+                        [history_images, *(record.images for record in past_events_snapshot)], preset
+                    )
+                else:
+                    history_encoded = []
+                    image_urls_per_event = [[] for _ in past_events_snapshot]
+                messages[head_size:] = restore_history_images(
+                    messages[head_size:], history_images_keep, dict(history_encoded)
+                )
 
-                    # 将消息中的图片转成 base64
-                    if preset.support_image:
-                        base64_images = await process_images(ev)
-                        for base64_image in base64_images:
-                            content.append({"type": "image_url", "image_url": {"url": f"data:image/jpeg;base64,{base64_image}"}})
+                # 消息在收到时已经格式化，这里只需要拼接
+                for record, image_urls in zip(past_events_snapshot, image_urls_per_event):
+                    content.append({"type": "text", "text": record.text})
+                    stored_content.append({"type": "text", "text": record.text})
+                    image_sources = dict(record.images)
+                    for key, image_url in image_urls:
+                        content.append({"type": "image_url", "image_url": {"url": image_url}})
+                        stored_content.append({"type": "image_ref", "image_ref": {"key": key, "url": image_sources[key]}})
 
                 new_messages: list[ChatCompletionMessageParam] = [
                     {"role": "user", "content": content}
@@ -455,84 +1024,71 @@ async def process_messages(context_id: int, is_group: bool = True):
                     available_tools = await mcp_client.get_available_tools(is_group)
                     client_config["tools"] = available_tools
 
-                response = await client.chat.completions.create(
-                    **client_config,
-                    messages=messages + new_messages,
+                # 按预设的上下文窗口裁剪历史记录，为回复预留max_tokens
+                fixed_tokens = (
+                    sum(estimate_message_tokens(message) for message in messages[:head_size])
+                    + sum(estimate_message_tokens(message) for message in new_messages)
+                    + estimate_tools_tokens(client_config.get("tools"))
                 )
-
-                if response.usage is not None:
-                    logger.debug(f"收到API响应 使用token数：{response.usage.total_tokens}")
-
-                message = response.choices[0].message
+                history_budget = (
+                    preset.context_window - preset.max_tokens - fixed_tokens if preset.context_window > 0 else sys.maxsize
+                )
+                history, history_tokens = trim_history(messages[head_size:], history_budget)
+                dropped_count = len(messages) - head_size - len(history)
+                if dropped_count > 0:
+                    logger.debug(f"历史记录超出token预算，丢弃最早的{dropped_count}条消息")
+                    messages = [*messages[:head_size], *history]
+                    if plugin_config.summary_preset:
+                        # 丢弃的对话移出历史记录并合并进摘要，避免之后被重复丢弃和重复总结
+                        dropped_messages = [state.history.popleft() for _ in range(dropped_count)]
+                        schedule_summary(context_id, is_group, state, dropped_messages)
+                        await persist_history_trimmed(context_id, is_group, len(state.history))
+                prompt_tokens_estimate = fixed_tokens + history_tokens
+
+                send_segment = create_segment_sender(handler)
+                on_reasoning = None
+                if state.output_reasoning_content:
+                    on_reasoning = partial(send_reasoning_forward, str(event.self_id), is_group, context_id)
+
+                message, usage = await create_chat_completion(
+                    client, preset, client_config, messages + new_messages, send_segment, on_reasoning
+                )
+                if usage is not None:
+                    logger.debug(f"估算输入token：{prompt_tokens_estimate} 实际输入token：{usage.prompt_tokens}")
 
                 # 处理响应并处理工具调用
                 while preset.support_mcp and message and message.tool_calls:
-                    llm_reply: ChatCompletionMessageParam = {
+                    llm_reply: ChatCompletionAssistantMessageParam = {
                         "role": "assistant",
                         "content": message.content,
-                        "tool_calls": [tool_call.model_dump() for tool_call in message.tool_calls]
+                        "tool_calls": [
+                            cast("ChatCompletionMessageToolCallParam", tool_call.model_dump())
+                            for tool_call in message.tool_calls
+                        ],
                     }
 
                     if preset.request_with_reasoning_content:
-                        llm_reply["reasoning_content"] = message.reasoning_content # pyright: ignore[reportGeneralTypeIssues]
+                        llm_reply["reasoning_content"] = getattr(message, "reasoning_content", None) # pyright: ignore[reportGeneralTypeIssues]
 
-                    # 发送LLM调用工具时的回复，一般没有
-                    if message.content:
+                    # 发送LLM调用工具时的回复，一般没有（流式模式下已经发送过了）
+                    if message.content and not preset.stream:
                         await send_split_messages(handler, message.content)
 
                     # 处理每个工具调用
                     new_messages.append(llm_reply)
 
-                    for tool_call in message.tool_calls:
-                        logger.debug(f"处理工具调用：{tool_call.function.name} 参数：{tool_call.function.arguments}")
-
-                        tool_name = tool_call.function.name
-                        try:
-                            tool_args = json.loads(tool_call.function.arguments)
-                        except (json.JSONDecodeError, TypeError, ValueError) as e:
-                            error_message = (
-                                f"工具调用参数格式错误，无法解析 {tool_name} 的 arguments: {e!s}. "
-                                f"原始参数: {tool_call.function.arguments}"
-                            )
-                            logger.warning(error_message)
-                            new_messages.append({
-                                "role": "tool",
-                                "tool_call_id": tool_call.id,
-                                "content": error_message,
-                            })
-                            continue
-
-                        # 发送工具调用提示
-                        await handler.send(Message(f"正在使用{mcp_client.get_friendly_name(tool_name)}"))
-
-                        if is_group:
-                            result = await mcp_client.call_tool(
-                                tool_name,
-                                tool_args,
-                                group_id=event.group_id,
-                                bot_id=str(event.self_id)
-                            )
-                        else:
-                            result = await mcp_client.call_tool(
-                                tool_name,
-                                tool_args,
-                                bot_id=str(event.self_id)
-                            )
-
-                        new_messages.append({
-                            "role": "tool",
-                            "tool_call_id": tool_call.id,
-                            "content": str(result)
-                        })
+                    new_messages += await execute_tool_calls(
+                        mcp_client,
+                        message.tool_calls,
+                        bot_id=str(event.self_id),
+                        group_id=event.group_id if isinstance(event, GroupMessageEvent) else None,
+                    )
 
                     # 将工具调用的结果交给 LLM
-                    response = await client.chat.completions.create(
-                        **client_config,
-                        messages=messages + new_messages,
+                    message, _ = await create_chat_completion(
+                        client, preset, client_config, messages + new_messages, send_segment, on_reasoning
                     )
 
-                    message = response.choices[0].message
-
                 # 安全检查：确保 message 不为 None
                 if not message:
                     logger.error("API 响应中的 message 为 None")
@@ -547,7 +1103,7 @@ async def process_messages(context_id: int, is_group: bool = True):
                     or matched_reasoning_content
                 )
 
-                llm_reply: ChatCompletionMessageParam = {
+                llm_reply: ChatCompletionAssistantMessageParam = {
                     "role": "assistant",
                     "content": reply,
                 }
@@ -564,31 +1120,27 @@ async def process_messages(context_id: int, is_group: bool = True):
                 new_messages.append(llm_reply)
 
                 # 请求成功后再保存历史记录，保证user和assistant穿插，防止R1模型报错
+                new_messages = digest_tool_results(new_messages)
+                new_messages[0] = cast("ChatCompletionMessageParam", {"role": "user", "content": stored_content})
+                evicted_messages = []
                 for message in new_messages:
+                    if len(state.history) == state.history.maxlen:
+                        evicted_messages.append(state.history[0])
                     state.history.append(message)
+                # 一轮对话的开头被移出后，剩下的assistant和tool消息也一起移出
+                while len(state.history) > 0 and state.history[0]["role"] != "user":
+                    evicted_messages.append(state.history.popleft())
+                if evicted_messages and plugin_config.summary_preset:
+                    schedule_summary(context_id, is_group, state, evicted_messages)
+                await persist_history(context_id, is_group, new_messages)
+
+                # 流式模式下思维过程和回复已经在接收时发送
+                if not preset.stream:
+                    if state.output_reasoning_content and reasoning_content:
+                        await send_reasoning_forward(str(event.self_id), is_group, context_id, reasoning_content)
 
-                if state.output_reasoning_content and reasoning_content:
-                    try:
-                        bot = get_bot(str(event.self_id))
-                        if is_group:
-                            await bot.send_group_forward_msg(
-                                group_id=group_id,
-                                messages=build_reasoning_forward_nodes(
-                                    bot.self_id, reasoning_content
-                                ),
-                            )
-                        else:
-                            await bot.send_private_forward_msg(
-                                user_id=context_id,
-                                messages=build_reasoning_forward_nodes(
-                                    bot.self_id, reasoning_content
-                                ),
-                            )
-                    except Exception as e:
-                        logger.error(f"合并转发消息发送失败：\n{e!s}\n")
-
-                assert reply is not None
-                await send_split_messages(handler, reply)
+                    assert reply is not None
+                    await send_split_messages(handler, reply)
 
                 if reply_images:
                     logger.debug(f"API响应 图片数：{len(reply_images)}")
@@ -611,6 +1163,34 @@ async def process_messages(context_id: int, is_group: bool = True):
         state.processing = False
 
 
+# 群成员变化时使OneBot工具的缓存失效
+MEMBERSHIP_NOTICE_TYPES = {"group_increase", "group_decrease", "group_admin", "group_card"}
+
+
+async def is_membership_notice(event: NoticeEvent) -> bool:
+    return event.notice_type in MEMBERSHIP_NOTICE_TYPES and hasattr(event, "group_id")
+
+
+membership_notice_handler = on_notice(rule=Rule(is_membership_notice), priority=99, block=False)
+
+
+@membership_notice_handler.handle()
+async def handle_membership_notice(event: NoticeEvent):
+    try:
+        mcp_client = MCPClient.instance()
+    except RuntimeError:
+        # MCPClient尚未初始化，还没有缓存
+        return
+    group_id = int(getattr(event, "group_id"))
+    user_id = getattr(event, "user_id", None)
+    mcp_client.onebot_tools.invalidate(
+        group_id,
+        int(user_id) if user_id is not None else None,
+        membership_changed=event.notice_type in ("group_increase", "group_decrease"),
+    )
+    logger.debug(f"群成员变化，清除OneBot工具缓存 群号：{group_id} 通知类型：{event.notice_type}")
+
+
 # 预设切换命令
 preset_handler = on_command("API预设", priority=1, block=True, permission=SUPERUSER)
 
@@ -635,14 +1215,14 @@ async def handle_preset(event: GroupMessageEvent | PrivateMessageEvent, args: Me
 
             # 判断目标是群聊还是私聊
             if target_id in group_states:
-                state = group_states[target_id]
+                state = await group_states.load(target_id)
                 is_group_target = True
             elif target_id in private_chat_states:
-                state = private_chat_states[target_id]
+                state = await private_chat_states.load(target_id)
                 is_group_target = False
             else:
                 # 默认创建私聊状态
-                state = private_chat_states[target_id]
+                state = await private_chat_states.load(target_id)
                 is_group_target = False
 
             # 如果只有目标 ID，没有预设名，返回当前预设
@@ -663,7 +1243,7 @@ async def handle_preset(event: GroupMessageEvent | PrivateMessageEvent, args: Me
             if not plugin_config.enable_private_chat:
                 return
             context_id = event.user_id
-            state = private_chat_states[context_id]
+            state = await private_chat_states.load(context_id)
             is_group_target = False
     else:
         # 普通情况：修改自己的预设
@@ -671,18 +1251,19 @@ async def handle_preset(event: GroupMessageEvent | PrivateMessageEvent, args: Me
 
         if isinstance(event, GroupMessageEvent):
             context_id = event.group_id
-            state = group_states[context_id]
+            state = await group_states.load(context_id)
             is_group_target = True
         else:  # PrivateMessageEvent
             if not plugin_config.enable_private_chat:
                 return
             context_id = event.user_id
-            state = private_chat_states[context_id]
+            state = await private_chat_states.load(context_id)
             is_group_target = False
 
     # 处理关闭功能
     if preset_name == "off":
         state.preset_name = preset_name
+        await persist_settings(context_id, is_group_target)
         if target_id:
             context_type = "群聊" if is_group_target else "私聊"
             await preset_handler.finish(f"已关闭 {context_type} {context_id} 的llmchat功能")
@@ -700,6 +1281,7 @@ async def handle_preset(event: GroupMessageEvent | PrivateMessageEvent, args: Me
 
     # 切换预设
     state.preset_name = preset_name
+    await persist_settings(context_id, is_group_target)
     if target_id:
         context_type = "群聊" if is_group_target else "私聊"
         await preset_handler.finish(f"已将 {context_type} {context_id} 切换至API预设：{preset_name}")
@@ -719,15 +1301,16 @@ edit_preset_handler = on_command(
 async def handle_edit_preset(event: GroupMessageEvent | PrivateMessageEvent, args: Message = CommandArg()):
     if isinstance(event, GroupMessageEvent):
         context_id = event.group_id
-        state = group_states[context_id]
+        state = await group_states.load(context_id)
     else:  # PrivateMessageEvent
         if not plugin_config.enable_private_chat:
             return
         context_id = event.user_id
-        state = private_chat_states[context_id]
+        state = await private_chat_states.load(context_id)
 
     group_prompt = args.extract_plain_text().strip()
     state.group_prompt = group_prompt
+    await persist_settings(context_id, isinstance(event, GroupMessageEvent))
     await edit_preset_handler.finish("修改成功")
 
 
@@ -743,15 +1326,22 @@ reset_handler = on_command(
 async def handle_reset(event: GroupMessageEvent | PrivateMessageEvent, args: Message = CommandArg()):
     if isinstance(event, GroupMessageEvent):
         context_id = event.group_id
-        state = group_states[context_id]
+        state = await group_states.load(context_id)
     else:  # PrivateMessageEvent
         if not plugin_config.enable_private_chat:
             return
         context_id = event.user_id
-        state = private_chat_states[context_id]
+        state = await private_chat_states.load(context_id)
 
     state.past_events.clear()
     state.history.clear()
+    if state.summary_task is not None:
+        state.summary_task.cancel()
+        state.summary_task = None
+    state.summary = None
+    state.summary_pending = []
+    await persist_settings(context_id, isinstance(event, GroupMessageEvent))
+    await persist_history_cleared(context_id, isinstance(event, GroupMessageEvent))
     await reset_handler.finish("记忆已清空")
 
 
@@ -766,7 +1356,7 @@ set_prob_handler = on_command(
 @set_prob_handler.handle()
 async def handle_set_prob(event: GroupMessageEvent, args: Message = CommandArg()):
     context_id = event.group_id
-    state = group_states[context_id]
+    state = await group_states.load(context_id)
 
     try:
         prob = float(args.extract_plain_text().strip())
@@ -777,6 +1367,7 @@ async def handle_set_prob(event: GroupMessageEvent, args: Message = CommandArg()
         return
 
     state.random_trigger_prob = prob
+    await persist_settings(context_id, True)
     await set_prob_handler.finish(f"主动回复概率已设为 {prob}")
 
 
@@ -792,19 +1383,62 @@ think_handler = on_command(
 @think_handler.handle()
 async def handle_think(event: GroupMessageEvent | PrivateMessageEvent, args: Message = CommandArg()):
     if isinstance(event, GroupMessageEvent):
-        state = group_states[event.group_id]
+        context_id = event.group_id
+        state = await group_states.load(context_id)
     else:  # PrivateMessageEvent
         if not plugin_config.enable_private_chat:
             return
-        state = private_chat_states[event.user_id]
+        context_id = event.user_id
+        state = await private_chat_states.load(context_id)
 
     state.output_reasoning_content = not state.output_reasoning_content
+    await persist_settings(context_id, isinstance(event, GroupMessageEvent))
 
     await think_handler.finish(
         f"已{(state.output_reasoning_content and '开启') or '关闭'}思维输出"
     )
 
 
+stats_handler = on_command("运行统计", priority=1, block=True, permission=SUPERUSER)
+
+
+@stats_handler.handle()
+async def handle_stats():
+    image_stats = image_cache.stats()
+    lookups = image_stats["hits"] + image_stats["misses"]
+    hit_rate = image_stats["hits"] / lookups if lookups else 0
+    lines = [
+        f"图片缓存：{image_stats['entries']}张 "
+        f"{image_stats['bytes'] / 1024 / 1024:.1f}/{image_stats['max_bytes'] / 1024 / 1024:.1f}MB",
+        f"命中：{image_stats['hits']} 磁盘命中：{image_stats['disk_hits']} "
+        f"未命中：{image_stats['misses']} 淘汰：{image_stats['evictions']} 命中率：{hit_rate:.1%}",
+    ]
+    state_size = sum(
+        estimate_state_size(state) for states in (group_states, private_chat_states) for state in states.values()
+    )
+    lines.append(
+        f"内存中的状态：{len(group_states)}个群聊 {len(private_chat_states)}个私聊 "
+        f"约{state_size / 1024 / 1024:.1f}MB，未加载：{len(group_states.unloaded) + len(private_chat_states.unloaded)}个"
+    )
+    for preset_name, stats in usage_stats.items():
+        cache_rate = stats["cached_tokens"] / stats["prompt_tokens"] if stats["prompt_tokens"] else 0
+        lines.append(
+            f"预设[{preset_name}]：请求{stats['requests']}次 输入token：{stats['prompt_tokens']} "
+            f"缓存命中：{stats['cached_tokens']}（{cache_rate:.1%}） 输出token：{stats['completion_tokens']}"
+        )
+    if plugin_config.mcp_servers:
+        try:
+            breaker_stats = MCPClient.instance().breaker_stats()
+        except RuntimeError:
+            breaker_stats = {}
+        for server_name, stats in breaker_stats.items():
+            lines.append(
+                f"MCP服务器[{server_name}]：{stats['state']} "
+                f"最近调用：{stats['calls']} 失败：{stats['failures']} 熔断次数：{stats['trips']}"
+            )
+    await stats_handler.finish("\n".join(lines))
+
+
 # region 持久化与定时任务
 
 # 获取插件数据目录
@@ -812,96 +1446,240 @@ data_dir = store.get_plugin_data_dir()
 # 获取插件数据文件
 data_file = store.get_plugin_data_file("llmchat_state.json")
 private_data_file = store.get_plugin_data_file("llmchat_private_state.json")
+# JSON存储，同时负责读取旧版状态文件
+json_store = JSONStateStore(
+    data_dir / "llmchat_state",
+    {"group": data_file, "private": private_data_file},
+    plugin_config.state_compress,
+)
 
 
-async def save_state():
-    """保存群组状态到文件"""
-    logger.info(f"开始保存群组状态到文件：{data_file}")
-    data = {
-        gid: {
-            "preset": state.preset_name,
-            "history": list(state.history),
-            "last_active": state.last_active,
-            "group_prompt": state.group_prompt,
-            "output_reasoning_content": state.output_reasoning_content,
-            "random_trigger_prob": state.random_trigger_prob,
-        }
-        for gid, state in group_states.items()
+def dump_state_settings(state: GroupState | PrivateChatState) -> dict:
+    """导出需要持久化的设置（不含历史记录）"""
+    settings = {
+        "preset": state.preset_name,
+        "last_active": state.last_active,
+        "group_prompt": state.group_prompt,
+        "output_reasoning_content": state.output_reasoning_content,
+        "summary": state.summary,
     }
+    if isinstance(state, GroupState):
+        settings["random_trigger_prob"] = state.random_trigger_prob
+    return settings
+
+
+def restore_state(state: GroupState | PrivateChatState, state_data: dict):
+    """从持久化数据恢复状态"""
+    state.preset_name = state_data["preset"]
+    state.history = deque(state_data["history"], maxlen=plugin_config.history_size * 2)
+    state.last_active = state_data["last_active"]
+    state.group_prompt = state_data["group_prompt"]
+    state.output_reasoning_content = state_data["output_reasoning_content"]
+    state.summary = state_data.get("summary")
+    if isinstance(state, GroupState):
+        random_trigger_prob = state_data.get("random_trigger_prob")
+        state.random_trigger_prob = (
+            random_trigger_prob if random_trigger_prob is not None else plugin_config.random_trigger_prob
+        )
 
-    os.makedirs(os.path.dirname(data_file), exist_ok=True)
-    async with aiofiles.open(data_file, "w", encoding="utf8") as f:
-        await f.write(json.dumps(data, ensure_ascii=False))
-
-    # 保存私聊状态
-    if plugin_config.enable_private_chat:
-        logger.info(f"开始保存私聊状态到文件：{private_data_file}")
-        private_data = {
-            uid: {
-                "preset": state.preset_name,
-                "history": list(state.history),
-                "last_active": state.last_active,
-                "group_prompt": state.group_prompt,
-                "output_reasoning_content": state.output_reasoning_content,
-            }
-            for uid, state in private_chat_states.items()
-        }
 
-        os.makedirs(os.path.dirname(private_data_file), exist_ok=True)
-        async with aiofiles.open(private_data_file, "w", encoding="utf8") as f:
-            await f.write(json.dumps(private_data, ensure_ascii=False))
+async def persist_settings(context_id: int, is_group: bool):
+    """设置变化后调用：SQLite存储立即保存设置，JSON存储标记为待保存"""
+    chat_type = "group" if is_group else "private"
+    if sqlite_store is None:
+        json_store.mark_dirty(chat_type, context_id)
+        return
+    state = await (group_states if is_group else private_chat_states).load(context_id)
+    await sqlite_store.save_settings(chat_type, [(context_id, dump_state_settings(state))])
 
 
-async def load_state():
-    """从文件加载群组状态"""
-    logger.info(f"从文件加载群组状态：{data_file}")
-    if not os.path.exists(data_file):
+async def persist_history(context_id: int, is_group: bool, messages: list["ChatCompletionMessageParam"]):
+    """历史记录提交后调用：SQLite存储立即追加消息，JSON存储标记为待保存"""
+    chat_type = "group" if is_group else "private"
+    if sqlite_store is None:
+        json_store.mark_dirty(chat_type, context_id)
+        return
+    try:
+        await sqlite_store.append_history(chat_type, context_id, cast("list[dict]", messages))
+        await persist_settings(context_id, is_group)
+    except Exception as e:
+        logger.opt(exception=e).error(f"写入SQLite历史记录失败 {'群号' if is_group else '用户'}：{context_id}")
+
+
+async def persist_history_trimmed(context_id: int, is_group: bool, keep: int):
+    """移出最早的历史记录后调用，只保留最近的keep条消息"""
+    chat_type = "group" if is_group else "private"
+    if sqlite_store is None:
+        json_store.mark_dirty(chat_type, context_id)
+        return
+    try:
+        await sqlite_store.keep_recent_history(chat_type, context_id, keep)
+    except Exception as e:
+        logger.opt(exception=e).error(f"裁剪SQLite历史记录失败 {'群号' if is_group else '用户'}：{context_id}")
+
+
+async def persist_history_cleared(context_id: int, is_group: bool):
+    """历史记录清空后调用"""
+    chat_type = "group" if is_group else "private"
+    if sqlite_store is None:
+        json_store.mark_dirty(chat_type, context_id)
         return
+    await sqlite_store.clear_history(chat_type, context_id)
 
-    async with aiofiles.open(data_file, encoding="utf8") as f:
-        data = json.loads(await f.read())
-        for gid, state_data in data.items():
-            state = GroupState()
-            state.preset_name = state_data["preset"]
-            state.history = deque(
-                state_data["history"], maxlen=plugin_config.history_size * 2
+
+# 定时保存、移出空闲状态和关闭插件时都会保存状态，同一时间只进行一次保存
+save_lock = asyncio.Lock()
+
+
+async def save_state():
+    """保存群组状态"""
+    async with save_lock:
+        await _save_state()
+
+
+async def _save_state():
+    if sqlite_store is not None:
+        # 历史记录已经实时写入，只需要保存设置（主要是最后活跃时间）
+        await sqlite_store.save_settings(
+            "group", [(gid, dump_state_settings(state)) for gid, state in group_states.items()]
+        )
+        if plugin_config.enable_private_chat:
+            await sqlite_store.save_settings(
+                "private", [(uid, dump_state_settings(state)) for uid, state in private_chat_states.items()]
             )
-            state.last_active = state_data["last_active"]
-            state.group_prompt = state_data["group_prompt"]
-            state.output_reasoning_content = state_data["output_reasoning_content"]
-            state.random_trigger_prob = state_data.get("random_trigger_prob", plugin_config.random_trigger_prob)
-            group_states[int(gid)] = state
-
-    # 加载私聊状态
-    if plugin_config.enable_private_chat:
-        logger.info(f"从文件加载私聊状态：{private_data_file}")
-        if os.path.exists(private_data_file):
-            async with aiofiles.open(private_data_file, encoding="utf8") as f:
-                private_data = json.loads(await f.read())
-                for uid, state_data in private_data.items():
-                    state = PrivateChatState()
-                    state.preset_name = state_data["preset"]
-                    state.history = deque(
-                        state_data["history"], maxlen=plugin_config.history_size * 2
-                    )
-                    state.last_active = state_data["last_active"]
-                    state.group_prompt = state_data["group_prompt"]
-                    state.output_reasoning_content = state_data["output_reasoning_content"]
-                    private_chat_states[int(uid)] = state
+        return
+
+    dirty = json_store.take_dirty()
+    if not any(dirty.values()):
+        return
+
+    logger.info(f"开始保存状态：{sum(len(ids) for ids in dirty.values())}个群聊/私聊有变化")
+    # 在事件循环中只复制引用，序列化和写入在线程中进行
+    index = {"group": group_states.all_settings(), "private": private_chat_states.all_settings()}
+    histories = {}
+    for chat_type, states in (("group", group_states), ("private", private_chat_states)):
+        for context_id in dirty[chat_type]:
+            # get不会触发__missing__，不会为了保存而加载尚未加载的上下文
+            state = states.get(context_id)
+            if state is not None:
+                histories[chat_type, context_id] = list(state.history)
+                continue
+            # 未加载但有变化的上下文来自旧版状态文件，直接写入其历史记录
+            legacy_history = json_store.legacy_history(chat_type, context_id)
+            if legacy_history is not None:
+                histories[chat_type, context_id] = list(legacy_history)
+
+    try:
+        await json_store.save(index, histories)
+    except Exception as e:
+        json_store.restore_dirty(dirty)
+        logger.opt(exception=e).error("保存状态失败，将在下次保存时重试")
+
+
+async def load_history(chat_type: str, context_id: int) -> list:
+    """读取单个上下文的历史记录，首次访问该上下文时调用"""
+    try:
+        if sqlite_store is not None:
+            return await sqlite_store.load_history(chat_type, context_id)
+        return await json_store.load_history(chat_type, context_id)
+    except Exception as e:
+        logger.opt(exception=e).error(f"读取历史记录失败 {chat_type}：{context_id}")
+        return []
+
+
+async def load_state():
+    """加载状态索引，各个上下文的历史记录在首次访问时加载"""
+    if sqlite_store is not None:
+        await sqlite_store.open()
+        # 首次启用SQLite时导入已有的JSON状态
+        if await sqlite_store.needs_import():
+            await sqlite_store.import_states(await json_store.load())
+            # 读取旧版状态文件时标记的变化只对JSON存储有意义
+            json_store.take_dirty()
+        group_states.unloaded = await sqlite_store.load_index("group")
+        private_chat_states.unloaded = await sqlite_store.load_index("private")
+    else:
+        # 未启用私聊时也加载私聊索引，保存时保留这些设置
+        index = await json_store.load_index()
+        group_states.unloaded = index["group"]
+        private_chat_states.unloaded = index["private"]
+    logger.info(f"已加载状态索引：{len(group_states.unloaded)}个群聊，{len(private_chat_states.unloaded)}个私聊")
+
+
+async def evict_states():
+    """将空闲的群聊/私聊保存后移出内存；超出内存预算时按最久未活跃的顺序继续移出"""
+    now = time.time()
+    idle_timeout = plugin_config.state_idle_timeout
+    victims: list[tuple[LazyStateDict, int]] = []
+    candidates: list[tuple[float, LazyStateDict, int]] = []
+    for states in (group_states, private_chat_states):
+        for context_id, state in states.items():
+            if state.processing or not state.queue.empty() or state.summary_task is not None:
+                continue
+            if idle_timeout > 0 and now - state.last_active > idle_timeout:
+                victims.append((states, context_id))
+            elif now - state.last_active > 60:
+                # 最近一分钟内活跃的不因内存预算移出
+                candidates.append((state.last_active, states, context_id))
+
+    if plugin_config.state_memory_budget > 0:
+        budget = plugin_config.state_memory_budget * 1024 * 1024
+        total = sum(estimate_state_size(state) for states in (group_states, private_chat_states) for state in states.values())
+        total -= sum(estimate_state_size(states[context_id]) for states, context_id in victims)
+        for _, states, context_id in sorted(candidates, key=lambda candidate: candidate[0]):
+            if total <= budget:
+                break
+            total -= estimate_state_size(states[context_id])
+            victims.append((states, context_id))
+
+    if not victims:
+        return
+
+    # 先保存变化，再移出内存
+    await save_state()
+    evicted = 0
+    for states, context_id in victims:
+        state = states.get(context_id)
+        # 保存期间收到了新消息，或者保存失败，则保留
+        if (
+            state is None
+            or state.processing
+            or not state.queue.empty()
+            or state.summary_task is not None
+            or state.last_active > now
+            or (sqlite_store is None and json_store.is_dirty(states.chat_type, context_id))
+        ):
+            continue
+        states.unload(context_id)
+        evicted += 1
+    logger.info(f"已将{evicted}个群聊/私聊移出内存")
 
 
 # 注册生命周期事件
 @driver.on_startup
 async def init_plugin():
     logger.info("插件启动初始化")
+    warn_if_pillow_missing(plugin_config.api_presets)
     await load_state()
     # 每5分钟保存状态
     scheduler.add_job(save_state, "interval", minutes=5)
+    # 每分钟将空闲的群聊/私聊移出内存
+    if plugin_config.state_idle_timeout > 0 or plugin_config.state_memory_budget > 0:
+        scheduler.add_job(evict_states, "interval", minutes=1)
+    # 每小时清理图片磁盘缓存
+    if plugin_config.image_cache_disk:
+        scheduler.add_job(image_cache.prune_disk, "interval", hours=1)
 
 
 @driver.on_shutdown
 async def cleanup_plugin():
     logger.info("插件关闭清理")
     await save_state()
+    if sqlite_store is not None:
+        await sqlite_store.close()
+    # 关闭OpenAI客户端连接池
+    await llm_client_pool.close()
+    # 关闭图片下载连接池
+    await image_downloader.close()
     # 销毁MCPClient单例
     await MCPClient.destroy_instance()
@@ -0,0 +1,93 @@
+from collections import deque
+from time import monotonic
+
+from nonebot import logger
+
+
+class CircuitBreaker:
+    """服务器熔断器
+
+    closed：正常放行，记录最近若干次调用的结果，失败率达到阈值时熔断；
+    open：拒绝所有调用，经过冷却时间后进入 half_open；
+    half_open：只放行一个探测调用，成功则恢复 closed，失败则重新 open。
+
+    每次熔断时代数加一，调用开始时记下当时的代数，熔断前开始、熔断后才结束的调用结果会被忽略。
+    """
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(self, name: str, failure_rate: float, min_calls: int, window: int, open_seconds: float):
+        self.name = name
+        self.failure_rate = failure_rate
+        self.min_calls = min_calls
+        self.open_seconds = open_seconds
+        # 最近的调用结果，True为成功
+        self._results: deque[bool] = deque(maxlen=max(window, min_calls, 1))
+        self._opened_at: float | None = None
+        self._probe_started: float | None = None
+        self.trips = 0
+        self.generation = 0
+
+    @property
+    def state(self) -> str:
+        if self._opened_at is None:
+            return self.CLOSED
+        if monotonic() - self._opened_at < self.open_seconds:
+            return self.OPEN
+        return self.HALF_OPEN
+
+    def allow_request(self) -> bool:
+        """是否放行本次调用"""
+        state = self.state
+        if state == self.CLOSED:
+            return True
+        if state == self.OPEN:
+            return False
+        # 半开状态同时只放行一个探测调用，探测调用迟迟没有结果时允许再次探测
+        now = monotonic()
+        if self._probe_started is not None and now - self._probe_started < self.open_seconds:
+            return False
+        self._probe_started = now
+        return True
+
+    def record_success(self, generation: int):
+        if generation != self.generation:
+            return
+        if self._opened_at is not None:
+            logger.info(f"MCP服务器[{self.name}]探测调用成功，熔断恢复")
+            self._opened_at = None
+            self._probe_started = None
+            self._results.clear()
+        self._results.append(True)
+
+    def record_failure(self, generation: int):
+        if generation != self.generation:
+            return
+        if self._opened_at is not None:
+            # 半开状态下探测失败，重新熔断
+            self._trip()
+            return
+        self._results.append(False)
+        if len(self._results) < self.min_calls:
+            return
+        failures = self._results.count(False)
+        if failures / len(self._results) >= self.failure_rate:
+            self._trip()
+
+    def _trip(self):
+        self._opened_at = monotonic()
+        self._probe_started = None
+        self._results.clear()
+        self.trips += 1
+        self.generation += 1
+        logger.warning(f"MCP服务器[{self.name}]调用失败率过高，熔断{self.open_seconds}秒")
+
+    def stats(self) -> dict[str, str | int]:
+        return {
+            "state": self.state,
+            "calls": len(self._results),
+            "failures": self._results.count(False),
+            "trips": self.trips,
+        }
@@ -1,4 +1,17 @@
-from pydantic import BaseModel, Field
+import re
+from typing import Literal
+
+from pydantic import BaseModel, Field, field_validator, model_validator
+
+
+def check_regexes(regexes: list[str] | None) -> list[str] | None:
+    """检查正则表达式是否合法，在加载配置时报告错误"""
+    for regex in regexes or ():
+        try:
+            re.compile(regex)
+        except re.error as e:
+            raise ValueError(f"正则表达式 {regex!r} 不合法: {e}") from e
+    return regexes
 
 
 class PresetConfig(BaseModel):
@@ -9,10 +22,25 @@ class PresetConfig(BaseModel):
     api_key: str = Field(..., description="API密钥")
     model_name: str = Field(..., description="模型名称")
     max_tokens: int = Field(2048, description="最大响应token数")
+    context_window: int = Field(
+        0, ge=0, description="模型上下文窗口大小（token），超出时丢弃最早的历史记录，0为只按条数保留历史记录"
+    )
     temperature: float = Field(0.7, description="生成温度（0-2]")
     proxy: str = Field("", description="HTTP代理服务器")
+    http2: bool = Field(False, description="是否启用HTTP/2（需要安装h2）")
+    max_connections: int = Field(20, ge=1, description="连接池最大连接数")
+    max_keepalive_connections: int = Field(10, ge=1, description="连接池最大保持活动连接数")
+    keepalive_expiry: float = Field(30.0, gt=0, description="空闲连接保持时间（秒）")
+    stream: bool = Field(False, description="是否使用流式输出，每段回复生成后立即发送")
     support_mcp: bool = Field(False, description="是否支持MCP")
     support_image: bool = Field(False, description="是否支持图片输入")
+    image_max_edge: int = Field(2048, ge=0, description="输入图片最长边的最大像素数，超过则缩小，0为不限制")
+    image_max_pixels: int = Field(0, ge=0, description="输入图片的最大像素总数，超过则缩小，0为不限制")
+    image_format: Literal["jpeg", "webp", "png", "original"] = Field(
+        "jpeg", description="输入图片重新编码的格式，original为不重新编码"
+    )
+    image_quality: int = Field(85, ge=1, le=100, description="输入图片重新编码的质量（1-100）")
+    history_images: int = Field(0, ge=0, description="请求时重新附上历史记录中最近的几张图片，其余图片用占位符代替")
     extra_body: dict = Field({}, description="额外的请求体字段，用于兼容不同API的特殊参数")
     request_with_reasoning_content: bool = Field(
         False,
@@ -27,10 +55,42 @@ class MCPServerConfig(BaseModel):
     url: str | None = Field(None, description="远程MCP服务器地址")
     headers: dict[str, str] | None = Field({}, description="远程MCP服务器http请求头，用于认证或其他设置")
     transport: str | None = Field(None, description="远程MCP传输协议类型，可选 'sse' 或 'streamable_http'，默认自动检测")
+    connect_timeout: float = Field(30.0, description="连接服务器并获取工具列表的超时时间（秒）")
+    tool_timeout: float = Field(30.0, description="调用工具的超时时间（秒）")
+    tools_cache_ttl: float | None = Field(
+        None, description="工具列表缓存时间（秒），不填则一直缓存，直到服务器通知工具列表变化"
+    )
 
     # 额外字段
     friendly_name: str | None = Field(None, description="MCP服务器友好名称")
     additional_prompt: str | None = Field(None, description="额外提示词")
+    parallel_tool_calls: bool = Field(True, description="是否允许同一轮中并发调用该服务器的工具")
+    result_max_length: int | None = Field(
+        None, ge=0, description="该服务器工具结果的最大字符数，不填则使用全局配置，0为不限制"
+    )
+    pool_size: int = Field(1, ge=1, description="每个服务器最多同时保持的会话数")
+    pool_min_size: int = Field(1, ge=0, description="空闲时保留的最少会话数")
+    pool_idle_timeout: float = Field(60, gt=0, description="超过最少会话数的会话空闲多久后回收（秒）")
+    breaker_failure_rate: float = Field(0.5, gt=0, le=1, description="最近调用的失败率达到该值时熔断")
+    breaker_min_calls: int = Field(5, ge=1, description="计算失败率所需的最少调用次数")
+    breaker_window: int = Field(20, ge=1, description="计算失败率的最近调用次数")
+    breaker_open_seconds: float = Field(60, description="熔断后多久放行一次探测调用（秒）")
+
+    @model_validator(mode="after")
+    def check_pool_size(self) -> "MCPServerConfig":
+        if self.pool_min_size > self.pool_size:
+            raise ValueError("pool_min_size 不能大于 pool_size")
+        return self
+
+class TriggerOverrideConfig(BaseModel):
+    """群聊触发规则，未设置的项沿用全局配置"""
+    keywords: list[str] | None = Field(None, description="触发关键词")
+    regexes: list[str] | None = Field(None, description="触发正则表达式")
+    nicknames: list[str] | None = Field(None, description="机器人的别名")
+    ignore_prefixes: list[str] | None = Field(None, description="需要忽略的消息前缀")
+
+    _check_regexes = field_validator("regexes")(check_regexes)
+
 
 class ScopedConfig(BaseModel):
     """LLM Chat Plugin配置"""
@@ -40,6 +100,24 @@ class ScopedConfig(BaseModel):
     )
     history_size: int = Field(20, description="LLM上下文消息保留数量")
     past_events_size: int = Field(10, description="触发回复时发送的群消息数量")
+    coalesce_window: float = Field(
+        0, ge=0, description="触发后等待后续触发的时间（秒），窗口内的多次触发合并成一次请求，0为不等待"
+    )
+    coalesce_max_wait: float = Field(3, ge=0, description="合并触发时从第一次触发开始最多等待的时间（秒）")
+    summary_preset: str | None = Field(None, description="总结被移出上下文的历史记录所用的预设名称，不填则不总结")
+    summary_max_length: int = Field(500, ge=50, description="历史记录摘要的最大字数")
+    state_storage: Literal["json", "sqlite"] = Field(
+        "json", description="状态存储方式，json为定时保存到文件，sqlite为实时写入SQLite数据库"
+    )
+    state_compress: bool = Field(False, description="使用json存储时是否用gzip压缩状态文件")
+    state_idle_timeout: int = Field(
+        0, ge=0, description="群聊/私聊空闲多久后从内存中移出（秒），移出时会丢弃未触发回复的群消息，0为不移出"
+    )
+    state_memory_budget: int = Field(0, ge=0, description="内存中群聊/私聊状态的估算大小上限（MB），0为不限制")
+    image_download_concurrency: int = Field(4, ge=1, description="单次请求中并发下载图片的最大数量")
+    image_cache_size: int = Field(64, ge=0, description="图片内存缓存大小（MB），0为关闭")
+    image_cache_disk: bool = Field(False, description="是否将下载的图片缓存到磁盘")
+    image_cache_disk_size: int = Field(512, ge=0, description="图片磁盘缓存大小（MB）")
     request_timeout: int = Field(30, description="API请求超时时间（秒）")
     default_preset: str = Field("off", description="默认使用的预设名称")
     random_trigger_prob: float = Field(
@@ -54,11 +132,23 @@ class ScopedConfig(BaseModel):
         description="command类型MCP服务器的全局工作目录（cwd）"
     )
     mcp_servers: dict[str, MCPServerConfig] = Field({}, description="MCP服务器配置")
+    tool_call_concurrency: int = Field(4, ge=1, description="同一轮中并发执行的工具调用数量上限")
+    tool_result_max_length: int = Field(0, ge=0, description="工具结果的最大字符数，超出部分截断，0为不限制")
+    tool_result_history_length: int = Field(
+        0, ge=0, description="保存到历史记录中的工具结果的最大字符数，只影响之后的请求，0为保存完整结果"
+    )
+    onebot_cache_ttl: float = Field(60, ge=0, description="OneBot只读工具查询结果的缓存时间（秒），0为不缓存")
     blacklist_user_ids: set[int] = Field(set(), description="黑名单用户ID列表")
     ignore_prefixes: list[str] = Field(
         default_factory=list,
         description="需要忽略的消息前缀列表，匹配到这些前缀的消息不会处理"
     )
+    trigger_keywords: list[str] = Field([], description="群聊消息包含这些关键词时触发回复")
+    trigger_regexes: list[str] = Field([], description="群聊消息匹配这些正则表达式时触发回复")
+    trigger_nicknames: list[str] = Field([], description="机器人的别名，群聊消息中任意位置提到时触发回复")
+    group_triggers: dict[int, TriggerOverrideConfig] = Field({}, description="按群号单独配置的触发规则")
+
+    _check_regexes = field_validator("trigger_regexes")(check_regexes)
     enable_private_chat: bool = Field(False, description="是否启用私聊功能")
     private_chat_preset: str = Field("off", description="私聊默认使用的预设名称")
 
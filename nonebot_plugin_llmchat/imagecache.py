@@ -0,0 +1,182 @@
+import asyncio
+from collections import OrderedDict
+from collections.abc import Hashable
+import hashlib
+import os
+from pathlib import Path
+
+import aiofiles
+from nonebot import logger
+
+
+class ImageCache:
+    """图片缓存，按图片来源（OneBot file id 或 url）和内容哈希两级索引
+
+    内存中按LRU淘汰，超过字节预算时淘汰最久未使用的图片；可选地将原始图片保存到磁盘。
+    同一内容按不同的预处理参数分别缓存编码结果（data url）。
+    """
+
+    def __init__(self, max_bytes: int, disk_dir: Path | None = None, disk_max_bytes: int = 0):
+        self.max_bytes = max_bytes
+        self.disk_dir = disk_dir
+        self.disk_max_bytes = disk_max_bytes
+        # 来源 -> 内容哈希
+        self._sources: dict[str, str] = {}
+        # 内容哈希 -> 引用该内容的来源
+        self._hash_sources: dict[str, set[str]] = {}
+        # 内容哈希 -> 该内容的缓存条目数
+        self._hash_entries: dict[str, int] = {}
+        # (内容哈希, 预处理参数) -> 编码后的图片，按最近使用排序
+        self._entries: OrderedDict[tuple[str, Hashable], str] = OrderedDict()
+        self._size = 0
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_bytes > 0
+
+    @staticmethod
+    def content_hash(image_data: bytes) -> str:
+        return hashlib.sha256(image_data).hexdigest()
+
+    def get(self, source: str, variant: Hashable) -> str | None:
+        """按来源获取编码后的图片，未命中时应读取图片后再调用 get_by_hash"""
+        content_hash = self._sources.get(source)
+        if content_hash is None:
+            return None
+        return self._get_entry(content_hash, variant)
+
+    def get_by_hash(self, source: str, content_hash: str, variant: Hashable) -> str | None:
+        """按内容哈希获取编码后的图片，命中时将来源关联到该内容，未命中时计为一次未命中"""
+        encoded = self._get_entry(content_hash, variant)
+        if encoded is None:
+            self.misses += 1
+        else:
+            self._link(source, content_hash)
+        return encoded
+
+    def _get_entry(self, content_hash: str, variant: Hashable) -> str | None:
+        key = (content_hash, variant)
+        encoded = self._entries.get(key)
+        if encoded is not None:
+            self._entries.move_to_end(key)
+            self.hits += 1
+        return encoded
+
+    def _link(self, source: str, content_hash: str):
+        old_hash = self._sources.get(source)
+        if old_hash is not None and old_hash != content_hash:
+            # 来源的内容变化时移除旧的反向关联，否则淘汰旧内容时会误删新的关联
+            old_sources = self._hash_sources.get(old_hash)
+            if old_sources is not None:
+                old_sources.discard(source)
+                if not old_sources:
+                    del self._hash_sources[old_hash]
+        self._sources[source] = content_hash
+        self._hash_sources.setdefault(content_hash, set()).add(source)
+
+    def put(self, source: str, content_hash: str, variant: Hashable, encoded: str):
+        """缓存编码后的图片"""
+        if not self.enabled or len(encoded) > self.max_bytes:
+            return
+        key = (content_hash, variant)
+        if key not in self._entries:
+            self._entries[key] = encoded
+            self._size += len(encoded)
+            self._hash_entries[content_hash] = self._hash_entries.get(content_hash, 0) + 1
+        self._entries.move_to_end(key)
+        self._link(source, content_hash)
+        self._evict()
+
+    def _evict(self):
+        while self._size > self.max_bytes and self._entries:
+            (content_hash, _), encoded = self._entries.popitem(last=False)
+            self._size -= len(encoded)
+            self._hash_entries[content_hash] -= 1
+            if self._hash_entries[content_hash] == 0:
+                del self._hash_entries[content_hash]
+                for source in self._hash_sources.pop(content_hash, ()):
+                    self._sources.pop(source, None)
+            self.evictions += 1
+
+    def _disk_path(self, source: str) -> Path | None:
+        if self.disk_dir is None:
+            return None
+        return self.disk_dir / hashlib.sha256(source.encode("utf-8")).hexdigest()
+
+    async def load_from_disk(self, source: str) -> bytes | None:
+        """从磁盘缓存读取原始图片"""
+        path = self._disk_path(source)
+        if path is None:
+            return None
+        try:
+            async with aiofiles.open(path, "rb") as f:
+                image_data = await f.read()
+        except FileNotFoundError:
+            return None
+        except OSError as e:
+            logger.warning(f"读取图片磁盘缓存失败: {e}")
+            return None
+        self.disk_hits += 1
+        return image_data
+
+    async def save_to_disk(self, source: str, image_data: bytes):
+        """将原始图片写入磁盘缓存"""
+        path = self._disk_path(source)
+        if path is None:
+            return
+        try:
+            path.parent.mkdir(parents=True, exist_ok=True)
+            async with aiofiles.open(path, "wb") as f:
+                await f.write(image_data)
+        except OSError as e:
+            logger.warning(f"写入图片磁盘缓存失败: {e}")
+
+    def _prune_disk_sync(self) -> int:
+        assert self.disk_dir is not None
+        files = []
+        total = 0
+        with os.scandir(self.disk_dir) as it:
+            for entry in it:
+                if entry.is_file():
+                    stat = entry.stat()
+                    files.append((stat.st_mtime, stat.st_size, entry.path))
+                    total += stat.st_size
+
+        removed = 0
+        for _, size, path in sorted(files):
+            if total <= self.disk_max_bytes:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            total -= size
+            removed += 1
+        return removed
+
+    async def prune_disk(self):
+        """按修改时间清理磁盘缓存，直到不超过磁盘预算"""
+        if self.disk_dir is None or not self.disk_dir.exists():
+            return
+        removed = await asyncio.to_thread(self._prune_disk_sync)
+        if removed:
+            logger.info(f"清理图片磁盘缓存{removed}个文件")
+
+    def stats(self) -> dict[str, int]:
+        """缓存统计信息
+
+        hits 和 misses 统计编码结果的内存缓存（按来源或内容哈希命中），disk_hits 统计从磁盘读取、免于下载的原始图片。
+        """
+        return {
+            "entries": len(self._entries),
+            "bytes": self._size,
+            "max_bytes": self.max_bytes,
+            "hits": self.hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+        }
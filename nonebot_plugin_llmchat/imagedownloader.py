@@ -0,0 +1,59 @@
+import asyncio
+import ssl
+
+import httpx
+from nonebot import logger
+
+
+class ImageDownloader:
+    """复用连接池的图片下载器，同一请求中的图片并发下载"""
+
+    def __init__(self, concurrency: int, timeout: float = 10.0):
+        self.concurrency = max(1, concurrency)
+        self.timeout = timeout
+        self._client: httpx.AsyncClient | None = None
+        # 处理高版本 httpx 的 [SSL: SSLV3_ALERT_HANDSHAKE_FAILURE] 报错，SSL上下文只创建一次
+        self._ssl_context = ssl.create_default_context()
+        self._ssl_context.check_hostname = False
+        self._ssl_context.verify_mode = ssl.CERT_NONE
+        self._ssl_context.set_ciphers("DEFAULT@SECLEVEL=2")
+
+    def _get_client(self) -> httpx.AsyncClient:
+        if self._client is None or self._client.is_closed:
+            self._client = httpx.AsyncClient(
+                verify=self._ssl_context,
+                timeout=self.timeout,
+                limits=httpx.Limits(
+                    max_connections=self.concurrency * 2,
+                    max_keepalive_connections=self.concurrency,
+                ),
+            )
+        return self._client
+
+    async def fetch(self, url: str) -> bytes | None:
+        """下载单张图片，失败时返回None"""
+        try:
+            response = await self._get_client().get(url)
+            if response.status_code != 200:
+                logger.error(f"下载图片失败: {url}, 状态码: {response.status_code}")
+                return None
+            return response.content
+        except Exception as e:
+            logger.error(f"下载图片时出错: {e}")
+            return None
+
+    async def fetch_all(self, urls: list[str]) -> list[bytes | None]:
+        """并发下载多张图片，返回结果与urls顺序一致"""
+        semaphore = asyncio.Semaphore(self.concurrency)
+
+        async def fetch_limited(url: str) -> bytes | None:
+            async with semaphore:
+                return await self.fetch(url)
+
+        return list(await asyncio.gather(*(fetch_limited(url) for url in urls)))
+
+    async def close(self):
+        """关闭连接池"""
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
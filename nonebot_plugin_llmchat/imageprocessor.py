@@ -0,0 +1,120 @@
+import base64
+from collections.abc import Iterable
+from io import BytesIO
+from typing import TYPE_CHECKING, NamedTuple
+
+from nonebot import logger
+
+if TYPE_CHECKING:
+    from .config import PresetConfig
+
+try:
+    from PIL import Image, ImageOps
+except ImportError:  # 未安装Pillow时只识别图片格式，不进行缩放和重新编码
+    Image = None
+    ImageOps = None
+
+
+class ImageOptions(NamedTuple):
+    """图片预处理参数，同时作为缓存键的一部分"""
+
+    max_edge: int
+    max_pixels: int
+    image_format: str
+    quality: int
+
+
+# (文件头, 起始偏移, MIME类型)
+_MAGIC_NUMBERS = (
+    (b"\xff\xd8\xff", 0, "image/jpeg"),
+    (b"\x89PNG\r\n\x1a\n", 0, "image/png"),
+    (b"GIF87a", 0, "image/gif"),
+    (b"GIF89a", 0, "image/gif"),
+    (b"WEBP", 8, "image/webp"),
+    (b"BM", 0, "image/bmp"),
+)
+
+_FORMAT_MIME_TYPES = {
+    "jpeg": "image/jpeg",
+    "webp": "image/webp",
+    "png": "image/png",
+}
+
+# 无需缩放时可以直接发送的格式
+_COMPACT_MIME_TYPES = {"image/jpeg", "image/webp"}
+
+
+def detect_mime_type(image_data: bytes) -> str:
+    """根据文件头识别图片的MIME类型，无法识别时按jpeg处理"""
+    for magic, offset, mime_type in _MAGIC_NUMBERS:
+        if image_data[offset : offset + len(magic)] == magic:
+            return mime_type
+    return "image/jpeg"
+
+
+def _to_data_url(mime_type: str, image_data: bytes) -> str:
+    return f"data:{mime_type};base64,{base64.b64encode(image_data).decode('utf-8')}"
+
+
+def _target_size(width: int, height: int, options: ImageOptions) -> tuple[int, int]:
+    scale = 1.0
+    if options.max_edge > 0 and max(width, height) > options.max_edge:
+        scale = options.max_edge / max(width, height)
+    if options.max_pixels > 0 and width * height * scale * scale > options.max_pixels:
+        scale = (options.max_pixels / (width * height)) ** 0.5
+    return max(1, int(width * scale)), max(1, int(height * scale))
+
+
+def warn_if_pillow_missing(presets: Iterable["PresetConfig"]):
+    """有预设需要缩放或重新编码图片但未安装Pillow时发出警告"""
+    if Image is not None:
+        return
+    names = [preset.name for preset in presets if preset.support_image and preset.image_format != "original"]
+    if names:
+        logger.warning(
+            f"预设[{', '.join(names)}]需要缩放或重新编码输入图片，但未安装Pillow，将直接发送原图"
+            "（pip install nonebot-plugin-llmchat[image]）"
+        )
+
+
+def preprocess_image(image_data: bytes, options: ImageOptions) -> str:
+    """识别格式、按需缩放并重新编码图片，返回data url
+
+    CPU密集，应在线程池中调用。
+    """
+    mime_type = detect_mime_type(image_data)
+    if Image is None or ImageOps is None or options.image_format == "original":
+        return _to_data_url(mime_type, image_data)
+
+    try:
+        with Image.open(BytesIO(image_data)) as image:
+            # 动图只取第一帧
+            image.seek(0)
+            image = ImageOps.exif_transpose(image)
+            target_size = _target_size(image.width, image.height, options)
+            resized = target_size != image.size
+            if not resized and mime_type in _COMPACT_MIME_TYPES:
+                return _to_data_url(mime_type, image_data)
+            if resized:
+                image = image.resize(target_size, Image.Resampling.LANCZOS)
+
+            image_format = options.image_format
+            if image_format == "jpeg" and image.mode != "RGB":
+                # jpeg不支持透明通道，透明部分填充为白色
+                rgba = image.convert("RGBA")
+                image = Image.new("RGB", rgba.size, (255, 255, 255))
+                image.paste(rgba, mask=rgba.getchannel("A"))
+            elif image.mode not in ("RGB", "RGBA"):
+                image = image.convert("RGBA")
+
+            output = BytesIO()
+            image.save(output, format=image_format.upper(), quality=options.quality)
+    except Exception as e:
+        logger.warning(f"图片预处理失败，使用原图: {e}")
+        return _to_data_url(mime_type, image_data)
+
+    encoded = output.getvalue()
+    if not resized and len(encoded) >= len(image_data):
+        # 重新编码没有变小时保留原图
+        return _to_data_url(mime_type, image_data)
+    return _to_data_url(_FORMAT_MIME_TYPES[image_format], encoded)
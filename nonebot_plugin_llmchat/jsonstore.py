@@ -0,0 +1,178 @@
+import asyncio
+import gzip
+import json
+import os
+from pathlib import Path
+import tempfile
+from typing import Any
+
+from nonebot import logger
+
+try:
+    import orjson
+except ImportError:  # 未安装orjson时使用标准库json
+    orjson = None
+
+CHAT_TYPES = ("group", "private")
+
+
+def _dumps(obj: Any) -> bytes:
+    if orjson is not None:
+        return orjson.dumps(obj)
+    return json.dumps(obj, ensure_ascii=False).encode("utf-8")
+
+
+def _loads(data: bytes) -> Any:
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+def _write_atomic(path: Path, data: bytes):
+    """先写入临时文件再重命名，写入过程中崩溃不会损坏原文件
+
+    临时文件名唯一，同一文件的并发写入不会互相覆盖临时文件。
+    """
+    path.parent.mkdir(parents=True, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(prefix=path.name + ".", suffix=".tmp", dir=path.parent)
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        Path(tmp_path).unlink(missing_ok=True)
+        raise
+
+
+class JSONStateStore:
+    """按上下文分文件保存的JSON状态存储
+
+    index.json 保存所有上下文的设置，每个上下文的历史记录单独保存在 <chat_type>/<上下文ID>.json 中，
+    只有发生变化的上下文会重新序列化。序列化、压缩和写入都在线程中执行，写入是原子的。
+    """
+
+    def __init__(self, directory: Path, legacy_files: dict[str, Path], compress: bool = False):
+        self.directory = directory
+        self.legacy_files = legacy_files
+        self.compress = compress
+        self._dirty: dict[str, set[int]] = {chat_type: set() for chat_type in CHAT_TYPES}
+        # 从旧版状态文件读取、尚未加载的历史记录
+        self._legacy_histories: dict[tuple[str, int], list] = {}
+
+    @property
+    def _suffix(self) -> str:
+        return ".json.gz" if self.compress else ".json"
+
+    @property
+    def _other_suffix(self) -> str:
+        return ".json" if self.compress else ".json.gz"
+
+    def _read(self, name: str) -> Any:
+        """读取文件，兼容切换压缩设置前写入的文件"""
+        for suffix in (self._suffix, self._other_suffix):
+            path = self.directory / (name + suffix)
+            if path.exists():
+                data = path.read_bytes()
+                return _loads(gzip.decompress(data) if suffix.endswith(".gz") else data)
+        return None
+
+    def _write(self, name: str, obj: Any):
+        data = _dumps(obj)
+        if self.compress:
+            data = gzip.compress(data, compresslevel=6)
+        _write_atomic(self.directory / (name + self._suffix), data)
+        # 删除切换压缩设置前写入的旧文件，避免读到过期数据
+        (self.directory / (name + self._other_suffix)).unlink(missing_ok=True)
+
+    def mark_dirty(self, chat_type: str, context_id: int):
+        self._dirty[chat_type].add(context_id)
+
+    def _load_legacy(self) -> dict[str, dict[int, dict[str, Any]]]:
+        index: dict[str, dict[int, dict[str, Any]]] = {chat_type: {} for chat_type in CHAT_TYPES}
+        for chat_type, legacy_file in self.legacy_files.items():
+            if not legacy_file.exists():
+                continue
+            legacy_data = json.loads(legacy_file.read_text(encoding="utf8"))
+            for context_id, state_data in legacy_data.items():
+                settings = dict(state_data)
+                self._legacy_histories[chat_type, int(context_id)] = settings.pop("history")
+                index[chat_type][int(context_id)] = settings
+            logger.info(f"从旧版状态文件读取{len(legacy_data)}个状态：{legacy_file}")
+            # 下次保存时写入新的目录结构
+            self._dirty[chat_type].update(index[chat_type])
+        return index
+
+    def _load_index(self) -> dict[str, dict[int, dict[str, Any]]]:
+        index = self._read("index")
+        if index is None:
+            return self._load_legacy()
+        return {
+            chat_type: {int(context_id): settings for context_id, settings in index.get(chat_type, {}).items()}
+            for chat_type in CHAT_TYPES
+        }
+
+    async def load_index(self) -> dict[str, dict[int, dict[str, Any]]]:
+        """只加载所有上下文的设置，返回 {chat_type: {上下文ID: 设置}}"""
+        return await asyncio.to_thread(self._load_index)
+
+    def _load_history(self, chat_type: str, context_id: int) -> list:
+        legacy_history = self._legacy_histories.pop((chat_type, context_id), None)
+        if legacy_history is not None:
+            return legacy_history
+        return self._read(f"{chat_type}/{context_id}") or []
+
+    async def load_history(self, chat_type: str, context_id: int) -> list:
+        """读取单个上下文的历史记录，读取、解压和解析在线程中进行"""
+        # 旧版历史记录已在内存中，直接在事件循环中取出，避免与保存时读取旧版历史记录交错
+        legacy_history = self._legacy_histories.pop((chat_type, context_id), None)
+        if legacy_history is not None:
+            return legacy_history
+        return await asyncio.to_thread(self._load_history, chat_type, context_id)
+
+    def legacy_history(self, chat_type: str, context_id: int) -> list | None:
+        """从旧版状态文件读取、尚未加载的历史记录"""
+        return self._legacy_histories.get((chat_type, context_id))
+
+    def _load(self) -> dict[str, dict[int, dict[str, Any]]]:
+        return {
+            chat_type: {
+                context_id: {**settings, "history": self._load_history(chat_type, context_id)}
+                for context_id, settings in states.items()
+            }
+            for chat_type, states in self._load_index().items()
+        }
+
+    async def load(self) -> dict[str, dict[int, dict[str, Any]]]:
+        """加载全部状态，返回 {chat_type: {上下文ID: 状态数据}}，状态数据格式与旧版状态文件一致"""
+        return await asyncio.to_thread(self._load)
+
+    def _save(self, index: dict[str, dict[int, dict[str, Any]]], histories: dict[tuple[str, int], list]):
+        for (chat_type, context_id), history in histories.items():
+            self._write(f"{chat_type}/{context_id}", history)
+        self._write("index", {chat_type: {str(k): v for k, v in settings.items()} for chat_type, settings in index.items()})
+
+    async def save(self, index: dict[str, dict[int, dict[str, Any]]], histories: dict[tuple[str, int], list]):
+        """保存所有上下文的设置，以及发生变化的上下文的历史记录
+
+        histories 中的历史记录应是快照（列表副本），序列化在线程中进行。
+        """
+        await asyncio.to_thread(self._save, index, histories)
+        # 已写入新文件的旧版历史记录不再需要保留在内存中
+        for key in histories:
+            self._legacy_histories.pop(key, None)
+
+    def is_dirty(self, chat_type: str, context_id: int) -> bool:
+        return context_id in self._dirty[chat_type]
+
+    def take_dirty(self) -> dict[str, set[int]]:
+        """取出自上次保存以来发生变化的上下文"""
+        dirty = self._dirty
+        self._dirty = {chat_type: set() for chat_type in CHAT_TYPES}
+        return dirty
+
+    def restore_dirty(self, dirty: dict[str, set[int]]):
+        """保存失败时放回变化的上下文，下次重试"""
+        for chat_type, context_ids in dirty.items():
+            self._dirty[chat_type].update(context_ids)
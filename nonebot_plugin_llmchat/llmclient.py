@@ -0,0 +1,68 @@
+import asyncio
+import importlib.util
+
+import httpx
+from nonebot import logger
+from openai import AsyncOpenAI
+
+from .config import PresetConfig
+
+
+class LLMClientPool:
+    """按预设复用的OpenAI客户端池，每个预设持有一个长连接的连接池"""
+
+    def __init__(self, request_timeout: float):
+        self.request_timeout = request_timeout
+        self._clients: dict[str, AsyncOpenAI] = {}
+        self._lock = asyncio.Lock()
+        self._http2_available = importlib.util.find_spec("h2") is not None
+
+    def _create_client(self, preset: PresetConfig) -> AsyncOpenAI:
+        http2 = preset.http2
+        if http2 and not self._http2_available:
+            logger.warning(f"预设[{preset.name}]启用了HTTP/2，但未安装h2，回退到HTTP/1.1")
+            http2 = False
+
+        http_client = httpx.AsyncClient(
+            proxy=preset.proxy or None,
+            http2=http2,
+            timeout=self.request_timeout,
+            limits=httpx.Limits(
+                max_connections=preset.max_connections,
+                max_keepalive_connections=preset.max_keepalive_connections,
+                keepalive_expiry=preset.keepalive_expiry,
+            ),
+        )
+        logger.debug(f"为预设[{preset.name}]创建OpenAI客户端 最大连接数：{preset.max_connections} HTTP/2：{http2}")
+        return AsyncOpenAI(
+            base_url=preset.api_base,
+            api_key=preset.api_key,
+            timeout=self.request_timeout,
+            http_client=http_client,
+        )
+
+    async def get_client(self, preset: PresetConfig) -> AsyncOpenAI:
+        """获取预设对应的客户端，不存在则创建"""
+        client = self._clients.get(preset.name)
+        if client is not None and not client.is_closed():
+            return client
+
+        async with self._lock:
+            client = self._clients.get(preset.name)
+            if client is None or client.is_closed():
+                client = self._create_client(preset)
+                self._clients[preset.name] = client
+            return client
+
+    async def close(self):
+        """关闭所有客户端及其连接池"""
+        async with self._lock:
+            clients = list(self._clients.items())
+            self._clients.clear()
+
+        for name, client in clients:
+            try:
+                await client.close()
+            except Exception as e:
+                logger.warning(f"关闭预设[{name}]的OpenAI客户端失败: {e}")
+        logger.debug(f"已关闭{len(clients)}个OpenAI客户端")
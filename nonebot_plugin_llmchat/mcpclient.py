@@ -1,5 +1,6 @@
 import asyncio
-from contextlib import AsyncExitStack
+from collections.abc import AsyncIterator, Awaitable, Callable
+from contextlib import AsyncExitStack, asynccontextmanager
 from time import monotonic
 from typing import Any, cast
 
@@ -8,22 +9,107 @@ from mcp import ClientSession, StdioServerParameters
 from mcp.client.sse import sse_client
 from mcp.client.stdio import stdio_client
 from mcp.client.streamable_http import streamable_http_client
+import mcp.types as mcp_types
 from nonebot import logger
 
+from .circuitbreaker import CircuitBreaker
 from .config import MCPServerConfig
 from .onebottools import OneBotTools
 
 
+def render_tool_content(content: list[Any]) -> str:
+    """将MCP工具返回的内容转成文本，非文本内容用占位符代替"""
+    parts = []
+    for item in content:
+        if item.type == "text":
+            parts.append(item.text)
+        elif item.type == "resource" and isinstance(getattr(item.resource, "text", None), str):
+            parts.append(item.resource.text)
+        else:
+            parts.append(f"[{item.type}]")
+    return "\n".join(parts)
+
+
+class _SessionHandle:
+    """由专属任务打开并持有的MCP会话
+
+    anyio要求传输和会话的上下文在同一个任务中进入和退出，
+    因此会话在专属任务中打开，关闭时通知该任务退出，可以在任意任务中安全关闭。
+    """
+
+    def __init__(self, server_name: str):
+        self.server_name = server_name
+        self.session: ClientSession
+        self.opened = False
+        self.last_used = monotonic()
+        # 正在该会话上进行的请求数
+        self.in_flight = 0
+        self._stop = asyncio.Event()
+        self._task: asyncio.Task | None = None
+
+    @property
+    def alive(self) -> bool:
+        """专属任务是否仍在运行，服务器崩溃或连接断开时任务会随传输一起结束"""
+        return self._task is not None and not self._task.done()
+
+    async def open(self, opener: Callable[[AsyncExitStack], Awaitable[ClientSession]]):
+        ready: asyncio.Future[ClientSession] = asyncio.get_running_loop().create_future()
+        self._task = asyncio.create_task(self._run(opener, ready))
+        try:
+            self.session = await asyncio.shield(ready)
+            self.opened = True
+        except BaseException:
+            # 打开失败或等待方被取消，结束专属任务并释放已经创建的资源
+            await self.close()
+            raise
+
+    async def _run(self, opener: Callable[[AsyncExitStack], Awaitable[ClientSession]], ready: asyncio.Future):
+        try:
+            async with AsyncExitStack() as session_stack:
+                session = await opener(session_stack)
+                if ready.done():
+                    return
+                ready.set_result(session)
+                await self._stop.wait()
+        except BaseException as e:
+            if not ready.done():
+                if isinstance(e, asyncio.CancelledError):
+                    ready.cancel()
+                else:
+                    ready.set_exception(e)
+                return
+            raise
+
+    async def close(self):
+        """通知专属任务关闭会话并等待资源释放"""
+        self._stop.set()
+        task = self._task
+        if task is None:
+            return
+        if not self.opened:
+            # 仍在打开中，直接取消
+            task.cancel()
+        try:
+            await task
+        except asyncio.CancelledError:
+            if not task.cancelled():
+                raise
+        except Exception as e:
+            logger.warning(f"关闭MCP服务器[{self.server_name}]会话时出错: {e}")
+
+
 class MCPClient:
     _instance = None
     _initialized = False
     _SESSION_TTL_SECONDS = 600
     _SESSION_CLEANUP_INTERVAL_SECONDS = 60
+    _TOOLS_RETRY_SECONDS = 60
 
     def __new__(
         cls,
         server_config: dict[str, MCPServerConfig] | None = None,
         default_command_cwd: str | None = None,
+        onebot_cache_ttl: float = 60,
     ):
         if cls._instance is None:
             cls._instance = super().__new__(cls)
@@ -33,6 +119,7 @@ class MCPClient:
         self,
         server_config: dict[str, MCPServerConfig] | None = None,
         default_command_cwd: str | None = None,
+        onebot_cache_ttl: float = 60,
     ):
         if self._initialized:
             return
@@ -43,17 +130,35 @@ class MCPClient:
         logger.info(f"正在初始化MCPClient单例，共有{len(server_config)}个服务器配置")
         self.server_config = server_config
         self.default_command_cwd = default_command_cwd
-        self.sessions = {}
+        # 每个服务器的会话池
+        self.sessions: dict[str, list[_SessionHandle]] = {}
         self.exit_stack = AsyncExitStack()
-        self._session_exit_stacks: dict[str, AsyncExitStack] = {}
-        self._session_last_used: dict[str, float] = {}
-        self._session_lock = asyncio.Lock()
+        # 每个服务器正在进行的会话创建，同一服务器的并发调用共享同一次创建
+        self._session_creating: dict[str, asyncio.Task[_SessionHandle]] = {}
         self._session_cleanup_task: asyncio.Task | None = None
-        # 添加工具列表缓存
-        self._tools_cache: list | None = None
+        # 按服务器缓存工具列表
+        self._server_tools: dict[str, tuple[dict[str, Any], ...]] = {}
+        self._server_tools_expire: dict[str, float] = {}
+        self._tools_refresh_tasks: dict[str, asyncio.Task] = {}
+        # 预先构建好的群聊/私聊工具列表，调用方不应修改
+        self._group_tools: tuple[dict[str, Any], ...] = ()
+        self._private_tools: tuple[dict[str, Any], ...] = ()
         self._cache_initialized = False
+        self._cache_lock = asyncio.Lock()
+        # 每个服务器的熔断器，熔断中的服务器不提供工具
+        self._breakers = {
+            server_name: CircuitBreaker(
+                server_name,
+                config.breaker_failure_rate,
+                config.breaker_min_calls,
+                config.breaker_window,
+                config.breaker_open_seconds,
+            )
+            for server_name, config in server_config.items()
+        }
+        self._hidden_servers: frozenset[str] = frozenset()
         # 初始化OneBot工具
-        self.onebot_tools = OneBotTools()
+        self.onebot_tools = OneBotTools(onebot_cache_ttl)
         self._initialized = True
         logger.debug("MCPClient单例初始化成功")
 
@@ -62,12 +167,13 @@ class MCPClient:
         cls,
         server_config: dict[str, MCPServerConfig] | None = None,
         default_command_cwd: str | None = None,
+        onebot_cache_ttl: float = 60,
     ):
         """获取MCPClient实例"""
         if cls._instance is None:
             if server_config is None:
                 raise ValueError("server_config must be provided for first initialization")
-            cls._instance = cls(server_config, default_command_cwd)
+            cls._instance = cls(server_config, default_command_cwd, onebot_cache_ttl)
         return cls._instance
 
     @classmethod
@@ -79,16 +185,82 @@ class MCPClient:
 
     async def connect_to_servers(self):
         await self._ensure_cleanup_task()
-        logger.info(f"开始连接{len(self.server_config)}个MCP服务器")
-        for server_name in self.server_config:
-            logger.debug(f"正在连接服务器[{server_name}]")
-            await self._get_or_create_session(server_name)
-            logger.info(f"已成功连接到MCP服务器[{server_name}]")
-
-    async def _create_server_session(self, server_name: str) -> tuple[ClientSession, AsyncExitStack]:
-        """创建并初始化一个新的服务器会话。"""
+        logger.info(f"开始并发连接{len(self.server_config)}个MCP服务器")
+        await asyncio.gather(
+            *(self._with_connect_timeout(server_name, self._connect_server(server_name)) for server_name in self.server_config)
+        )
+
+    async def _with_connect_timeout(self, server_name: str, coro):
+        """为连接服务器相关的操作加上该服务器的超时，失败时只记录日志并返回None"""
+        timeout = self.server_config[server_name].connect_timeout
+        try:
+            return await asyncio.wait_for(coro, timeout=timeout)
+        except asyncio.TimeoutError:
+            logger.error(f"连接MCP服务器[{server_name}]超时（{timeout}秒），跳过该服务器")
+        except Exception as e:
+            logger.opt(exception=e).error(f"连接MCP服务器[{server_name}]失败，跳过该服务器")
+        return None
+
+    async def _connect_server(self, server_name: str) -> _SessionHandle:
+        """获取服务器会话池中负载最低的会话，池为空则创建
+
+        创建在任何锁之外进行，每个服务器同时只有一个创建任务，并发调用方共享其结果，
+        因此一个卡住的服务器不会阻塞其他服务器的调用。
+        """
+        handle = self._least_loaded_session(server_name)
+        if handle is not None:
+            return handle
+        return await self._wait_session_creation(server_name)
+
+    def _least_loaded_session(self, server_name: str) -> _SessionHandle | None:
+        return min(
+            (handle for handle in self.sessions.get(server_name, ()) if handle.alive),
+            key=lambda handle: handle.in_flight,
+            default=None,
+        )
+
+    def _start_session_creation(self, server_name: str) -> asyncio.Task[_SessionHandle]:
+        """启动或复用服务器的会话创建任务"""
+        task = self._session_creating.get(server_name)
+        if task is None:
+            logger.debug(f"正在连接服务器[{server_name}]，当前会话数：{len(self.sessions.get(server_name, ()))}")
+            task = asyncio.create_task(self._create_server_session(server_name))
+            # 所有等待方都被取消时也要取走异常，避免未处理异常的警告
+            task.add_done_callback(lambda t: t.cancelled() or t.exception())
+            self._session_creating[server_name] = task
+        return task
+
+    async def _wait_session_creation(self, server_name: str) -> _SessionHandle:
+        return await asyncio.shield(self._start_session_creation(server_name))
+
+    def _grow_pool(self, server_name: str):
+        """在后台新建会话扩容会话池，不阻塞当前调用，失败时只记录日志"""
+        if server_name in self._session_creating:
+            return
+
+        def log_failure(task: asyncio.Task[_SessionHandle]):
+            if not task.cancelled() and task.exception() is not None:
+                logger.warning(f"服务器[{server_name}]扩容会话失败，继续使用已有会话: {task.exception()!r}")
+
+        self._start_session_creation(server_name).add_done_callback(log_failure)
+
+    async def _create_server_session(self, server_name: str) -> _SessionHandle:
+        """创建并初始化一个新的服务器会话并加入会话池，超过连接超时时间则放弃。"""
+        handle = _SessionHandle(server_name)
+        try:
+            await asyncio.wait_for(
+                handle.open(lambda session_stack: self._open_server_session(server_name, session_stack)),
+                timeout=self.server_config[server_name].connect_timeout,
+            )
+            self.sessions.setdefault(server_name, []).append(handle)
+        finally:
+            self._session_creating.pop(server_name, None)
+        logger.info(f"已成功连接到MCP服务器[{server_name}]，当前会话数：{len(self.sessions[server_name])}")
+        return handle
+
+    async def _open_server_session(self, server_name: str, session_stack: AsyncExitStack) -> ClientSession:
+        """建立传输连接并初始化会话，资源注册到session_stack中。"""
         config = self.server_config[server_name]
-        session_stack = AsyncExitStack()
         if config.url:
             transport_type = config.transport
             if transport_type == "streamable_http":
@@ -133,54 +305,79 @@ class MCPClient:
             raise ValueError("Server config must have either url or command")
 
         read, write = transport
-        session = await session_stack.enter_async_context(ClientSession(read, write))
+        session = await session_stack.enter_async_context(
+            ClientSession(read, write, message_handler=self._create_message_handler(server_name))
+        )
         await session.initialize()
-        return session, session_stack
+        return session
 
-    async def _close_server_session(self, server_name: str):
-        """关闭指定服务器会话。"""
-        session_stack = self._session_exit_stacks.pop(server_name, None)
-        self.sessions.pop(server_name, None)
-        self._session_last_used.pop(server_name, None)
+    async def _close_server_session(self, server_name: str, handle: _SessionHandle):
+        """将会话从会话池中移除并关闭。"""
+        pool = self.sessions.get(server_name, [])
+        if handle in pool:
+            pool.remove(handle)
+        await handle.close()
 
-        if session_stack is not None:
-            await session_stack.aclose()
-
-    async def _get_or_create_session(self, server_name: str) -> ClientSession:
-        """获取可复用会话；若不存在或已过期则新建。"""
+    async def _acquire_session(self, server_name: str) -> _SessionHandle:
+        """从会话池中取出负载最低的会话；会话都在使用中且未达到池上限时在后台新建会话。"""
+        config = self.server_config[server_name]
         now = monotonic()
-        async with self._session_lock:
-            last_used = self._session_last_used.get(server_name)
-            session = self.sessions.get(server_name)
-
-            # 空闲超过阈值则销毁重建
-            if session is not None and last_used is not None:
-                if now - last_used > self._SESSION_TTL_SECONDS:
-                    logger.info(f"服务器[{server_name}]会话空闲超过10分钟，重新创建")
-                    await self._close_server_session(server_name)
-                    session = None
 
-            if session is None:
-                session, session_stack = await self._create_server_session(server_name)
-                self.sessions[server_name] = session
-                self._session_exit_stacks[server_name] = session_stack
-
-            self._session_last_used[server_name] = now
-            return self.sessions[server_name]
+        # 已断开的会话和空闲超过阈值的会话销毁重建
+        dead = [handle for handle in self.sessions.get(server_name, ()) if not handle.alive]
+        if dead:
+            logger.warning(f"服务器[{server_name}]有{len(dead)}个会话已断开，重新创建")
+        expired = [
+            handle
+            for handle in self.sessions.get(server_name, ())
+            if handle.alive and handle.in_flight == 0 and now - handle.last_used > self._SESSION_TTL_SECONDS
+        ]
+        if expired:
+            logger.info(f"服务器[{server_name}]有{len(expired)}个会话空闲超过10分钟，重新创建")
+        if dead or expired:
+            await asyncio.gather(*(self._close_server_session(server_name, handle) for handle in [*dead, *expired]))
+
+        handle = self._least_loaded_session(server_name)
+        if handle is None:
+            handle = await self._wait_session_creation(server_name)
+        elif handle.in_flight > 0 and len(self.sessions[server_name]) < config.pool_size:
+            # 后台扩容，当前调用直接使用负载最低的已有会话
+            self._grow_pool(server_name)
+
+        handle.in_flight += 1
+        handle.last_used = monotonic()
+        return handle
+
+    @asynccontextmanager
+    async def _use_session(self, server_name: str) -> AsyncIterator[_SessionHandle]:
+        """在调用期间占用一个会话，用于按负载分配会话"""
+        handle = await self._acquire_session(server_name)
+        try:
+            yield handle
+        finally:
+            handle.in_flight -= 1
+            handle.last_used = monotonic()
 
     async def _cleanup_expired_sessions(self):
-        """回收空闲过期会话。"""
+        """回收空闲会话：超过10分钟的全部回收，超过最少会话数的空闲会话提前回收，在锁外并发关闭。"""
         now = monotonic()
-        async with self._session_lock:
-            expired_servers = [
-                server_name
-                for server_name, last_used in self._session_last_used.items()
-                if now - last_used > self._SESSION_TTL_SECONDS
-            ]
-
-            for server_name in expired_servers:
-                logger.info(f"回收空闲MCP会话[{server_name}]")
-                await self._close_server_session(server_name)
+        expired: list[_SessionHandle] = []
+        for server_name, pool in self.sessions.items():
+            config = self.server_config[server_name]
+            remaining = len(pool)
+            # 最久未使用的会话优先回收
+            for handle in sorted(pool, key=lambda handle: handle.last_used):
+                if handle.in_flight > 0:
+                    continue
+                idle = now - handle.last_used
+                if idle > self._SESSION_TTL_SECONDS or (remaining > config.pool_min_size and idle > config.pool_idle_timeout):
+                    expired.append(handle)
+                    remaining -= 1
+
+        for handle in expired:
+            logger.info(f"回收空闲MCP会话[{handle.server_name}]")
+            self.sessions[handle.server_name].remove(handle)
+        await asyncio.gather(*(handle.close() for handle in expired))
 
     async def _session_cleanup_loop(self):
         try:
@@ -195,48 +392,119 @@ class MCPClient:
         if self._session_cleanup_task is None or self._session_cleanup_task.done():
             self._session_cleanup_task = asyncio.create_task(self._session_cleanup_loop())
 
+    async def _list_server_tools(self, server_name: str) -> list[dict[str, Any]]:
+        """连接服务器并获取工具列表"""
+        logger.debug(f"正在从服务器[{server_name}]获取工具列表")
+        async with self._use_session(server_name) as handle:
+            response = await handle.session.list_tools()
+        tools = response.tools
+        logger.debug(f"在服务器[{server_name}]中找到{len(tools)}个工具")
+
+        return [
+            {
+                "type": "function",
+                "function": {
+                    "name": f"mcp__{server_name}__{tool.name}",
+                    "description": tool.description,
+                    "parameters": tool.inputSchema,
+                },
+            }
+            for tool in tools
+        ]
+
+    def _create_message_handler(self, server_name: str):
+        """处理服务器推送的消息，工具列表变化时刷新该服务器的工具缓存"""
+
+        async def message_handler(message):
+            if isinstance(message, mcp_types.ServerNotification) and isinstance(
+                message.root, mcp_types.ToolListChangedNotification
+            ):
+                logger.info(f"服务器[{server_name}]的工具列表已变化，刷新工具缓存")
+                self._schedule_tools_refresh(server_name)
+
+        return message_handler
+
+    def _store_server_tools(self, server_name: str, tools: list[dict[str, Any]] | None):
+        """保存服务器的工具列表并记录过期时间，获取失败的服务器稍后重试"""
+        ttl = self.server_config[server_name].tools_cache_ttl
+        if tools is None:
+            self._server_tools.pop(server_name, None)
+            self._server_tools_expire[server_name] = monotonic() + self._TOOLS_RETRY_SECONDS
+            logger.warning(f"服务器[{server_name}]的工具不可用，{self._TOOLS_RETRY_SECONDS}秒后重试")
+        else:
+            self._server_tools[server_name] = tuple(tools)
+            self._server_tools_expire[server_name] = monotonic() + ttl if ttl else float("inf")
+
+    def _rebuild_tool_lists(self):
+        """按配置顺序重新构建群聊和私聊的工具列表"""
+        mcp_tools = tuple(
+            tool
+            for server_name in self.server_config
+            if server_name not in self._hidden_servers
+            for tool in self._server_tools.get(server_name, ())
+        )
+        self._private_tools = mcp_tools
+        # 群聊场景，包含OneBot工具和MCP工具
+        self._group_tools = mcp_tools + tuple(self.onebot_tools.get_available_tools())
+
+    async def _refresh_server_tools(self, server_name: str):
+        tools = await self._with_connect_timeout(server_name, self._list_server_tools(server_name))
+        self._store_server_tools(server_name, tools)
+        self._rebuild_tool_lists()
+        if tools is not None:
+            logger.info(f"服务器[{server_name}]工具缓存已刷新，共{len(tools)}个工具")
+
+    def _schedule_tools_refresh(self, server_name: str):
+        """在后台刷新单个服务器的工具列表，同一服务器同时只有一个刷新任务"""
+        task = self._tools_refresh_tasks.get(server_name)
+        if task is not None and not task.done():
+            return
+        task = asyncio.create_task(self._refresh_server_tools(server_name))
+        task.add_done_callback(lambda _: self._tools_refresh_tasks.pop(server_name, None))
+        self._tools_refresh_tasks[server_name] = task
+
     async def init_tools_cache(self):
-        """初始化工具列表缓存"""
-        if not self._cache_initialized:
+        """初始化工具列表缓存，并发连接所有服务器，连接失败或超时的服务器不提供工具"""
+        if self._cache_initialized:
+            return
+        async with self._cache_lock:
+            if self._cache_initialized:
+                return
             await self._ensure_cleanup_task()
-            available_tools = []
             logger.info(f"初始化工具列表缓存，需要连接{len(self.server_config)}个服务器")
-            for server_name in self.server_config.keys():
-                logger.debug(f"正在从服务器[{server_name}]获取工具列表")
-                session = await self._get_or_create_session(server_name)
-                response = await session.list_tools()
-                tools = response.tools
-                logger.debug(f"在服务器[{server_name}]中找到{len(tools)}个工具")
-
-                available_tools.extend(
-                    {
-                        "type": "function",
-                        "function": {
-                            "name": f"mcp__{server_name}__{tool.name}",
-                            "description": tool.description,
-                            "parameters": tool.inputSchema,
-                        },
-                    }
-                    for tool in tools
-                )
-
-            # 缓存工具列表
-            self._tools_cache = available_tools
+            server_names = list(self.server_config)
+            results = await asyncio.gather(
+                *(self._with_connect_timeout(server_name, self._list_server_tools(server_name)) for server_name in server_names)
+            )
+
+            for server_name, tools in zip(server_names, results):
+                self._store_server_tools(server_name, tools)
+            self._rebuild_tool_lists()
             self._cache_initialized = True
 
-            logger.info(f"工具列表缓存完成，共缓存{len(available_tools)}个工具")
+            logger.info(f"工具列表缓存完成，共缓存{len(self._private_tools)}个工具")
 
-    async def get_available_tools(self, is_group: bool):
-        """获取可用工具列表，使用缓存机制"""
+    async def get_available_tools(self, is_group: bool) -> tuple[dict[str, Any], ...]:
+        """获取可用工具列表，过期的服务器在后台刷新，本次请求先使用当前缓存"""
         await self.init_tools_cache()
-        available_tools = self._tools_cache.copy() if self._tools_cache else []
-        if is_group:
-            # 群聊场景，包含OneBot工具和MCP工具
-            available_tools.extend(self.onebot_tools.get_available_tools())
+        now = monotonic()
+        for server_name, expire_at in self._server_tools_expire.items():
+            if now >= expire_at:
+                self._schedule_tools_refresh(server_name)
+
+        hidden_servers = frozenset(
+            server_name for server_name, breaker in self._breakers.items() if breaker.state == CircuitBreaker.OPEN
+        )
+        if hidden_servers != self._hidden_servers:
+            logger.info(f"熔断中的MCP服务器：{', '.join(hidden_servers) or '无'}，更新可用工具列表")
+            self._hidden_servers = hidden_servers
+            self._rebuild_tool_lists()
+
+        available_tools = self._group_tools if is_group else self._private_tools
         logger.debug(f"获取可用工具列表，共{len(available_tools)}个工具")
         return available_tools
 
-    async def call_tool(self, tool_name: str, tool_args: dict, group_id: int | None = None, bot_id: str | None = None):
+    async def call_tool(self, tool_name: str, tool_args: dict, group_id: int | None = None, bot_id: str | None = None) -> str:
         """按需调用工具，MCP会话会在10分钟空闲后自动回收。"""
         # 检查是否是OneBot内置工具
         if tool_name.startswith("ob__"):
@@ -254,26 +522,70 @@ class MCPClient:
 
             server_name = parts[1]
             real_tool_name = parts[2]
-            logger.info(f"按需连接到服务器[{server_name}]调用工具[{real_tool_name}]")
+            if server_name not in self.server_config:
+                return f"未知的MCP服务器: {server_name}"
+
+            breaker = self._breakers[server_name]
+            if not breaker.allow_request():
+                logger.warning(f"服务器[{server_name}]熔断中，跳过工具[{real_tool_name}]")
+                return f"服务器[{server_name}]暂时不可用，请稍后再试"
+            # 熔断前开始的调用的结果不影响熔断后的状态
+            generation = breaker.generation
 
+            logger.info(f"按需连接到服务器[{server_name}]调用工具[{real_tool_name}]")
+            timeout = self.server_config[server_name].tool_timeout
+            handle = None
             try:
                 await self._ensure_cleanup_task()
-                session = await self._get_or_create_session(server_name)
-                response = await asyncio.wait_for(session.call_tool(real_tool_name, tool_args), timeout=30)
+                async with self._use_session(server_name) as handle:
+                    response = await asyncio.wait_for(handle.session.call_tool(real_tool_name, tool_args), timeout=timeout)
+                breaker.record_success(generation)
                 logger.debug(f"工具[{real_tool_name}]调用完成，响应: {response}")
-                return response.content
+                return render_tool_content(response.content)
             except asyncio.TimeoutError:
+                breaker.record_failure(generation)
                 logger.error(f"调用工具[{real_tool_name}]超时")
                 return f"调用工具[{real_tool_name}]超时"
-            except (RuntimeError, ValueError, TypeError, OSError, ConnectionError) as e:
+            except Exception as e:
+                # 服务器崩溃时进行中的调用抛出McpError，之后同一会话上的调用抛出anyio的流关闭异常，
+                # 都计入熔断失败并重置会话
+                breaker.record_failure(generation)
                 logger.opt(exception=e).error(f"调用工具[{real_tool_name}]失败，准备重置会话")
-                async with self._session_lock:
-                    await self._close_server_session(server_name)
-                return f"调用工具[{real_tool_name}]失败: {e!s}"
+                if handle is not None:
+                    await self._close_server_session(server_name, handle)
+                return f"调用工具[{real_tool_name}]失败: {str(e) or type(e).__name__}"
 
         # 未知工具类型
         return f"未知的工具类型: {tool_name}"
 
+    def is_server_available(self, server_name: str) -> bool:
+        """服务器是否未处于熔断状态"""
+        breaker = self._breakers.get(server_name)
+        return breaker is None or breaker.state != CircuitBreaker.OPEN
+
+    def breaker_stats(self) -> dict[str, dict[str, str | int]]:
+        """各服务器熔断器的统计信息"""
+        return {server_name: breaker.stats() for server_name, breaker in self._breakers.items()}
+
+    def get_serial_server(self, tool_name: str) -> str | None:
+        """如果工具所在的MCP服务器不允许并发调用，返回服务器名称"""
+        if not tool_name.startswith("mcp__"):
+            return None
+        parts = tool_name.split("__")
+        if len(parts) != 3 or parts[1] not in self.server_config:
+            return None
+        server_name = parts[1]
+        return None if self.server_config[server_name].parallel_tool_calls else server_name
+
+    def get_result_max_length(self, tool_name: str, default: int) -> int:
+        """工具结果的最大长度，MCP服务器可以单独配置"""
+        parts = tool_name.split("__")
+        if len(parts) == 3 and parts[0] == "mcp" and parts[1] in self.server_config:
+            result_max_length = self.server_config[parts[1]].result_max_length
+            if result_max_length is not None:
+                return result_max_length
+        return default
+
     def get_friendly_name(self, tool_name: str):
         logger.debug(tool_name)
         # 检查是否是OneBot内置工具
@@ -297,7 +609,13 @@ class MCPClient:
     def clear_tools_cache(self):
         """清除工具列表缓存"""
         logger.info("清除工具列表缓存")
-        self._tools_cache = None
+        for task in self._tools_refresh_tasks.values():
+            task.cancel()
+        self._tools_refresh_tasks.clear()
+        self._server_tools.clear()
+        self._server_tools_expire.clear()
+        self._group_tools = ()
+        self._private_tools = ()
         self._cache_initialized = False
 
     async def cleanup(self):
@@ -314,9 +632,12 @@ class MCPClient:
                 pass
             self._session_cleanup_task = None
 
-        async with self._session_lock:
-            for server_name in list(self.sessions.keys()):
-                await self._close_server_session(server_name)
+        for task in self._session_creating.values():
+            task.cancel()
+        self._session_creating.clear()
+        handles = [handle for pool in self.sessions.values() for handle in pool]
+        self.sessions.clear()
+        await asyncio.gather(*(handle.close() for handle in handles))
 
         await self.exit_stack.aclose()
         # 重新初始化exit_stack以便后续使用
@@ -6,10 +6,21 @@ from nonebot import get_bot, logger
 from nonebot.adapters.onebot.v11 import Bot
 
 
+def _dumps(obj: Any) -> str:
+    """紧凑的JSON，不缩进、不加空格，减少工具结果占用的token"""
+    return json.dumps(obj, ensure_ascii=False, separators=(",", ":"))
+
+
 class OneBotTools:
     """内置的OneBot群操作工具类"""
 
-    def __init__(self):
+    # 群成员列表每页的成员数
+    MEMBER_LIST_PAGE_SIZE = 100
+
+    def __init__(self, cache_ttl: float = 60):
+        # 只读查询结果按群缓存：群号 -> {缓存键 -> (过期时间, 结果)}
+        self.cache_ttl = cache_ttl
+        self._cache: dict[int, dict[str, tuple[float, Any]]] = {}
         self.tools = [
             {
                 "type": "function",
@@ -55,8 +66,13 @@ class OneBotTools:
                 "type": "function",
                 "function": {
                     "name": "ob__get_group_member_list",
-                    "description": "获取群成员列表。",
-                    "parameters": {"type": "object", "properties": {}, "required": []},
+                    "description": f"分页获取群成员列表，每页最多{self.MEMBER_LIST_PAGE_SIZE}人，"
+                    "返回的成员列表中每一项依次为QQ号、昵称、群名片、角色。",
+                    "parameters": {
+                        "type": "object",
+                        "properties": {"page": {"type": "integer", "description": "页码，从1开始，默认为1"}},
+                        "required": [],
+                    },
                 },
             },
             {
@@ -113,6 +129,41 @@ class OneBotTools:
         }
         return friendly_names.get(tool_name, tool_name)
 
+    def _get_cached(self, group_id: int, key: str) -> Any:
+        entry = self._cache.get(group_id, {}).get(key)
+        if entry is None:
+            return None
+        expire_at, result = entry
+        if time.monotonic() >= expire_at:
+            del self._cache[group_id][key]
+            return None
+        logger.debug(f"OneBot工具缓存命中 群号：{group_id} 键：{key}")
+        return result
+
+    def _set_cached(self, group_id: int, key: str, result: Any):
+        if self.cache_ttl <= 0:
+            return
+        now = time.monotonic()
+        group_cache = self._cache.setdefault(group_id, {})
+        # 顺便清理该群已过期的缓存
+        for expired_key in [k for k, (expire_at, _) in group_cache.items() if now >= expire_at]:
+            del group_cache[expired_key]
+        group_cache[key] = (now + self.cache_ttl, result)
+
+    def invalidate(self, group_id: int, user_id: int | None = None, membership_changed: bool = False):
+        """使群缓存失效：成员信息变化时清除该成员和成员列表，成员增减时还会清除群信息"""
+        group_cache = self._cache.get(group_id)
+        if not group_cache:
+            return
+        group_cache.pop("member_list", None)
+        if user_id is None:
+            for key in [k for k in group_cache if k.startswith("member:")]:
+                del group_cache[key]
+        else:
+            group_cache.pop(f"member:{user_id}", None)
+        if membership_changed:
+            group_cache.pop("group_info", None)
+
     def get_available_tools(self) -> list[dict[str, Any]]:
         """获取可用的工具列表"""
         return self.tools
@@ -150,6 +201,7 @@ class OneBotTools:
 
         try:
             await bot.set_group_ban(group_id=group_id, user_id=user_id, duration=duration)
+            self.invalidate(group_id, user_id)
             if duration > 0:
                 return f"成功禁言用户 {user_id}，时长 {duration} 秒"
             else:
@@ -159,6 +211,8 @@ class OneBotTools:
 
     async def _get_group_info(self, bot: Bot, group_id: int, _args: dict[str, Any]) -> str:
         """获取群信息"""
+        if (cached := self._get_cached(group_id, "group_info")) is not None:
+            return cached
         try:
             group_info = await bot.get_group_info(group_id=group_id)
             info = {
@@ -167,13 +221,17 @@ class OneBotTools:
                 "群成员数": group_info["member_count"],
                 "群上限": group_info["max_member_count"],
             }
-            return json.dumps(info, ensure_ascii=False, indent=2)
+            result = _dumps(info)
+            self._set_cached(group_id, "group_info", result)
+            return result
         except Exception as e:
             return f"获取群信息失败: {e!s}"
 
     async def _get_group_member_info(self, bot: Bot, group_id: int, args: dict[str, Any]) -> str:
         """获取群成员信息"""
         user_id = int(args["user_id"])
+        if (cached := self._get_cached(group_id, f"member:{user_id}")) is not None:
+            return cached
 
         try:
             member_info = await bot.get_group_member_info(group_id=group_id, user_id=user_id)
@@ -190,24 +248,35 @@ class OneBotTools:
                 "角色": member_info["role"],
                 "专属头衔": member_info["title"],
             }
-            return json.dumps(info, ensure_ascii=False, indent=2)
+            result = _dumps(info)
+            self._set_cached(group_id, f"member:{user_id}", result)
+            return result
         except Exception as e:
             return f"获取成员信息失败: {e!s}"
 
-    async def _get_group_member_list(self, bot: Bot, group_id: int, _args: dict[str, Any]) -> str:
-        """获取群成员列表"""
-        try:
-            member_list = await bot.get_group_member_list(group_id=group_id)
-            members = []
-            for member in member_list:
-                members.append(
-                    {"QQ": member["user_id"], "昵称": member["nickname"], "群名片": member["card"], "角色": member["role"]}
-                )
-
-            result = {"群成员总数": len(members), "成员列表": members}
-            return json.dumps(result, ensure_ascii=False, indent=2)
-        except Exception as e:
-            return f"获取群成员列表失败: {e!s}"
+    async def _get_group_member_list(self, bot: Bot, group_id: int, args: dict[str, Any]) -> str:
+        """分页获取群成员列表，缓存完整的列表"""
+        members = self._get_cached(group_id, "member_list")
+        if members is None:
+            try:
+                member_list = await bot.get_group_member_list(group_id=group_id)
+            except Exception as e:
+                return f"获取群成员列表失败: {e!s}"
+            # 每个成员只保留值，字段名在描述中说明，避免每个成员重复一遍
+            members = [[member["user_id"], member["nickname"], member["card"], member["role"]] for member in member_list]
+            self._set_cached(group_id, "member_list", members)
+
+        page_size = self.MEMBER_LIST_PAGE_SIZE
+        total_pages = max((len(members) + page_size - 1) // page_size, 1)
+        page = min(max(int(args.get("page") or 1), 1), total_pages)
+        return _dumps(
+            {
+                "群成员总数": len(members),
+                "页码": page,
+                "总页数": total_pages,
+                "成员列表": members[(page - 1) * page_size : page * page_size],
+            }
+        )
 
     async def _poke_user(self, bot: Bot, group_id: int, args: dict[str, Any]) -> str:
         """戳一戳用户"""
@@ -237,6 +306,7 @@ class OneBotTools:
 
         try:
             await bot.set_group_card(group_id=group_id, user_id=user_id, card=card)
+            self.invalidate(group_id, user_id)
             if card:
                 return f"成功修改用户 {user_id} 的群名片为: {card}"
             else:
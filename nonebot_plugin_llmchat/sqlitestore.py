@@ -0,0 +1,198 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+import json
+from pathlib import Path
+import sqlite3
+from typing import Any
+
+from nonebot import logger
+
+# 与JSON状态文件中的字段一一对应
+SETTINGS_FIELDS = ("preset", "last_active", "group_prompt", "output_reasoning_content", "random_trigger_prob", "summary")
+
+_INSERT_SETTINGS = (
+    f"INSERT OR REPLACE INTO settings (chat_type, context_id, {', '.join(SETTINGS_FIELDS)}) "
+    f"VALUES (?, ?, {', '.join('?' * len(SETTINGS_FIELDS))})"
+)
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS settings (
+    chat_type TEXT NOT NULL,
+    context_id INTEGER NOT NULL,
+    preset TEXT,
+    last_active REAL,
+    group_prompt TEXT,
+    output_reasoning_content INTEGER,
+    random_trigger_prob REAL,
+    summary TEXT,
+    PRIMARY KEY (chat_type, context_id)
+);
+CREATE TABLE IF NOT EXISTS messages (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    chat_type TEXT NOT NULL,
+    context_id INTEGER NOT NULL,
+    message TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS messages_context ON messages (chat_type, context_id, id);
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+"""
+
+
+class SQLiteStore:
+    """基于SQLite（WAL模式）的状态存储
+
+    历史消息在提交时逐条追加，每个上下文只保留最近 history_limit 条；群组/私聊设置单独保存在 settings 表中。
+    所有数据库操作都在同一个工作线程中串行执行，不阻塞事件循环。
+    chat_type 为 "group" 或 "private"。
+    """
+
+    def __init__(self, path: Path, history_limit: int):
+        self.path = path
+        self.history_limit = history_limit
+        self._conn: sqlite3.Connection | None = None
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="llmchat-sqlite")
+
+    async def _run(self, func, *args):
+        return await asyncio.get_running_loop().run_in_executor(self._executor, func, *args)
+
+    @property
+    def conn(self) -> sqlite3.Connection:
+        if self._conn is None:
+            raise RuntimeError("SQLiteStore has not been opened")
+        return self._conn
+
+    def _open(self):
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        conn = sqlite3.connect(self.path, check_same_thread=False)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.executescript(_SCHEMA)
+        # 旧版数据库没有后来增加的列
+        columns = {row[1] for row in conn.execute("PRAGMA table_info(settings)")}
+        for field in SETTINGS_FIELDS:
+            if field not in columns:
+                conn.execute(f"ALTER TABLE settings ADD COLUMN {field}")
+        conn.commit()
+        self._conn = conn
+
+    async def open(self):
+        await self._run(self._open)
+        logger.info(f"已打开SQLite状态存储：{self.path}")
+
+    def _close(self):
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+    async def close(self):
+        await self._run(self._close)
+        self._executor.shutdown(wait=False)
+
+    def _append_history(self, chat_type: str, context_id: int, messages: list[str]):
+        with self.conn:
+            self.conn.executemany(
+                "INSERT INTO messages (chat_type, context_id, message) VALUES (?, ?, ?)",
+                [(chat_type, context_id, message) for message in messages],
+            )
+            # 只保留最近的history_limit条消息
+            self._delete_old_history(chat_type, context_id, self.history_limit)
+
+    async def append_history(self, chat_type: str, context_id: int, messages: list[dict[str, Any]]):
+        """追加已提交的历史消息"""
+        if not messages:
+            return
+        serialized = [json.dumps(message, ensure_ascii=False) for message in messages]
+        await self._run(self._append_history, chat_type, context_id, serialized)
+
+    def _delete_old_history(self, chat_type: str, context_id: int, keep: int):
+        self.conn.execute(
+            "DELETE FROM messages WHERE chat_type = ? AND context_id = ? AND id <= ("
+            "SELECT id FROM messages WHERE chat_type = ? AND context_id = ? ORDER BY id DESC LIMIT 1 OFFSET ?)",
+            (chat_type, context_id, chat_type, context_id, keep),
+        )
+
+    def _keep_recent_history(self, chat_type: str, context_id: int, keep: int):
+        with self.conn:
+            self._delete_old_history(chat_type, context_id, keep)
+
+    async def keep_recent_history(self, chat_type: str, context_id: int, keep: int):
+        """只保留最近的keep条历史消息"""
+        await self._run(self._keep_recent_history, chat_type, context_id, keep)
+
+    def _clear_history(self, chat_type: str, context_id: int):
+        with self.conn:
+            self.conn.execute("DELETE FROM messages WHERE chat_type = ? AND context_id = ?", (chat_type, context_id))
+
+    async def clear_history(self, chat_type: str, context_id: int):
+        await self._run(self._clear_history, chat_type, context_id)
+
+    def _save_settings(self, chat_type: str, rows: list[tuple[int, dict[str, Any]]]):
+        with self.conn:
+            self.conn.executemany(
+                _INSERT_SETTINGS,
+                [(chat_type, context_id, *(settings.get(field) for field in SETTINGS_FIELDS)) for context_id, settings in rows],
+            )
+
+    async def save_settings(self, chat_type: str, rows: list[tuple[int, dict[str, Any]]]):
+        """保存群组/私聊设置，rows为(上下文ID, 设置)列表"""
+        if rows:
+            await self._run(self._save_settings, chat_type, rows)
+
+    def _load_index(self, chat_type: str) -> dict[int, dict[str, Any]]:
+        index: dict[int, dict[str, Any]] = {}
+        for row in self.conn.execute(
+            f"SELECT context_id, {', '.join(SETTINGS_FIELDS)} FROM settings WHERE chat_type = ?", (chat_type,)
+        ):
+            settings: dict[str, Any] = dict(zip(SETTINGS_FIELDS, row[1:]))
+            settings["output_reasoning_content"] = bool(settings["output_reasoning_content"])
+            index[row[0]] = settings
+        return index
+
+    async def load_index(self, chat_type: str) -> dict[int, dict[str, Any]]:
+        """只加载所有上下文的设置"""
+        return await self._run(self._load_index, chat_type)
+
+    def _load_history(self, chat_type: str, context_id: int) -> list:
+        return [
+            json.loads(message)
+            for (message,) in self.conn.execute(
+                "SELECT message FROM messages WHERE chat_type = ? AND context_id = ? ORDER BY id", (chat_type, context_id)
+            )
+        ]
+
+    async def load_history(self, chat_type: str, context_id: int) -> list:
+        """读取单个上下文的历史记录，只涉及一次索引查询"""
+        return await self._run(self._load_history, chat_type, context_id)
+
+    def _needs_import(self) -> bool:
+        return self.conn.execute("SELECT value FROM meta WHERE key = 'json_imported'").fetchone() is None
+
+    async def needs_import(self) -> bool:
+        """是否还没有导入过JSON状态"""
+        return await self._run(self._needs_import)
+
+    def _import_states(self, data: dict[str, dict[int, dict[str, Any]]]):
+        with self.conn:
+            for chat_type, states in data.items():
+                for context_id, state_data in states.items():
+                    self.conn.execute(
+                        _INSERT_SETTINGS,
+                        (chat_type, context_id, *(state_data.get(field) for field in SETTINGS_FIELDS)),
+                    )
+                    self.conn.execute("DELETE FROM messages WHERE chat_type = ? AND context_id = ?", (chat_type, context_id))
+                    self.conn.executemany(
+                        "INSERT INTO messages (chat_type, context_id, message) VALUES (?, ?, ?)",
+                        [
+                            (chat_type, context_id, json.dumps(message, ensure_ascii=False))
+                            for message in state_data["history"][-self.history_limit :]
+                        ],
+                    )
+            self.conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('json_imported', '1')")
+
+    async def import_states(self, data: dict[str, dict[int, dict[str, Any]]]):
+        """一次性导入JSON存储中的全部状态，data格式为 {chat_type: {上下文ID: 状态数据}}"""
+        await self._run(self._import_states, data)
+        logger.info(f"已导入{sum(len(states) for states in data.values())}个JSON状态到SQLite")
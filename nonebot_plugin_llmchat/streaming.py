@@ -0,0 +1,160 @@
+from collections.abc import AsyncIterable, Awaitable, Callable
+from typing import TYPE_CHECKING, Any
+
+from openai.types.chat import ChatCompletionMessage
+
+if TYPE_CHECKING:
+    from openai.types import CompletionUsage
+    from openai.types.chat import ChatCompletionChunk
+
+THINK_START = "<think>"
+THINK_END = "</think>"
+SEGMENT_SEPARATOR = "<botbr>"
+
+
+class ReplySegmenter:
+    """增量解析流式回复
+
+    与 pop_reasoning_content 一致，只过滤回复开头的 <think> 块；每当一个 <botbr> 闭合时返回完整的分段。
+    """
+
+    def __init__(self):
+        self._buffer = ""
+        # start: 尚未确定是否以<think>开头；think: 位于<think>块内；content: 正文
+        self._state = "start"
+        self._raw_parts: list[str] = []
+        self.reasoning_content: str | None = None
+
+    @property
+    def raw_content(self) -> str:
+        """未经过滤的完整回复，与非流式响应的 message.content 一致"""
+        return "".join(self._raw_parts)
+
+    @property
+    def in_content(self) -> bool:
+        return self._state == "content"
+
+    def feed(self, text: str) -> list[str]:
+        """输入新的文本片段，返回已经闭合的分段"""
+        self._raw_parts.append(text)
+        self._buffer += text
+
+        if self._state == "start":
+            if len(self._buffer) < len(THINK_START) and THINK_START.startswith(self._buffer):
+                return []
+            if self._buffer.startswith(THINK_START):
+                self._state = "think"
+            else:
+                self._state = "content"
+
+        if self._state == "think":
+            end = self._buffer.find(THINK_END, len(THINK_START))
+            if end < 0:
+                return []
+            self.reasoning_content = self._buffer[len(THINK_START) : end].strip()
+            self._buffer = self._buffer[end + len(THINK_END) :]
+            self._state = "content"
+
+        segments = []
+        while (index := self._buffer.find(SEGMENT_SEPARATOR)) >= 0:
+            segment = self._buffer[:index]
+            self._buffer = self._buffer[index + len(SEGMENT_SEPARATOR) :]
+            segments.append(segment)
+        return segments
+
+    def finish(self) -> list[str]:
+        """流结束，返回剩余的最后一个分段"""
+        if self._state == "think":
+            # <think>没有闭合，和 pop_reasoning_content 一样当作正文处理
+            self._state = "content"
+            return [*self.feed(""), self._flush()]
+        return [self._flush()]
+
+    def _flush(self) -> str:
+        segment = self._buffer
+        self._buffer = ""
+        return segment
+
+
+class ToolCallAccumulator:
+    """按index拼接流式返回的工具调用增量"""
+
+    def __init__(self):
+        self._tool_calls: dict[int, dict[str, Any]] = {}
+
+    def feed(self, tool_call_deltas):
+        for delta in tool_call_deltas:
+            tool_call = self._tool_calls.setdefault(
+                delta.index,
+                {"id": "", "type": "function", "function": {"name": "", "arguments": ""}},
+            )
+            if delta.id:
+                tool_call["id"] = delta.id
+            if delta.function is not None:
+                if delta.function.name:
+                    tool_call["function"]["name"] += delta.function.name
+                if delta.function.arguments:
+                    tool_call["function"]["arguments"] += delta.function.arguments
+
+    def result(self) -> list[dict[str, Any]]:
+        return [self._tool_calls[index] for index in sorted(self._tool_calls)]
+
+
+async def consume_stream(
+    stream: AsyncIterable["ChatCompletionChunk"],
+    on_segment: Callable[[str], Awaitable[None]],
+    on_reasoning: Callable[[str], Awaitable[None]] | None = None,
+) -> tuple[ChatCompletionMessage, "CompletionUsage | None"]:
+    """消费流式响应，分段闭合时立即回调发送，返回拼接后的完整消息和token用量"""
+    segmenter = ReplySegmenter()
+    tool_calls = ToolCallAccumulator()
+    reasoning_parts: list[str] = []
+    images: list[Any] = []
+    usage = None
+    reasoning_sent = False
+
+    async def send_reasoning():
+        nonlocal reasoning_sent
+        if reasoning_sent:
+            return
+        reasoning_sent = True
+        reasoning_content = "".join(reasoning_parts) or segmenter.reasoning_content
+        if on_reasoning is not None and reasoning_content:
+            await on_reasoning(reasoning_content)
+
+    async for chunk in stream:
+        if chunk.usage is not None:
+            usage = chunk.usage
+        if not chunk.choices:
+            continue
+
+        delta = chunk.choices[0].delta
+        if reasoning := getattr(delta, "reasoning_content", None):
+            reasoning_parts.append(reasoning)
+        if delta.tool_calls:
+            tool_calls.feed(delta.tool_calls)
+        if delta_images := getattr(delta, "images", None):
+            images.extend(delta_images)
+        if delta.content:
+            segments = segmenter.feed(delta.content)
+            if segmenter.in_content and (segments or delta.content.strip()):
+                # 正文开始输出，说明思考已经结束
+                await send_reasoning()
+            for segment in segments:
+                await on_segment(segment)
+
+    for segment in segmenter.finish():
+        await send_reasoning()
+        await on_segment(segment)
+    await send_reasoning()
+
+    message: dict[str, Any] = {
+        "role": "assistant",
+        "content": segmenter.raw_content or None,
+        "reasoning_content": "".join(reasoning_parts) or None,
+    }
+    if tool_calls.result():
+        message["tool_calls"] = tool_calls.result()
+    if images:
+        message["images"] = images
+    return ChatCompletionMessage.model_validate(message), usage
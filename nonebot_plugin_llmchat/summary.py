@@ -0,0 +1,50 @@
+from collections.abc import Iterable, Mapping
+from typing import Any
+
+SUMMARY_SYSTEM_PROMPT = (
+    "你负责为一个聊天机器人整理长期记忆。"
+    "你会收到已有的记忆摘要和一段更早的聊天记录，请把两者合并成一份新的摘要。"
+    "摘要应保留参与者的昵称和QQ号、他们的偏好和身份、重要的事实、约定和未完成的话题，省略寒暄和无关的细节。"
+    "只输出摘要本身，不要输出其他内容。"
+)
+
+
+def _content_text(content: Any) -> str:
+    if isinstance(content, str):
+        return content
+    if isinstance(content, list):
+        return "\n".join(part["text"] if part.get("type") == "text" else "[图片]" for part in content)
+    return ""
+
+
+def render_transcript(messages: Iterable[Mapping[str, Any]], max_tool_result_length: int = 200) -> str:
+    """将历史消息转成供总结用的纯文本，工具结果只保留开头部分"""
+    lines = []
+    for message in messages:
+        role = message["role"]
+        text = _content_text(message.get("content"))
+        if role == "user":
+            lines.append(f"[收到的消息]\n{text}")
+        elif role == "assistant":
+            if text:
+                lines.append(f"[你的回复]\n{text}")
+            for tool_call in message.get("tool_calls") or ():
+                lines.append(f"[你调用了工具] {tool_call['function']['name']} {tool_call['function']['arguments']}")
+        elif role == "tool":
+            if len(text) > max_tool_result_length:
+                text = text[:max_tool_result_length] + "…"
+            lines.append(f"[工具结果]\n{text}")
+    return "\n".join(lines)
+
+
+def build_summary_messages(previous: str | None, transcript: str, max_length: int) -> list[dict[str, str]]:
+    """构建总结请求的消息"""
+    return [
+        {"role": "system", "content": SUMMARY_SYSTEM_PROMPT},
+        {
+            "role": "user",
+            "content": f"已有的记忆摘要：\n{previous or '无'}\n\n"
+            f"更早的聊天记录：\n{transcript}\n\n"
+            f"请输出合并后的记忆摘要，不超过{max_length}字。",
+        },
+    ]
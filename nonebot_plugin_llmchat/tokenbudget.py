@@ -0,0 +1,69 @@
+from collections.abc import Iterable, Mapping
+import json
+from typing import Any
+
+# 每条消息的角色、分隔符等固定开销
+MESSAGE_OVERHEAD_TOKENS = 4
+# 图片按一张高清图的典型开销估算
+IMAGE_TOKENS = 765
+
+
+def estimate_tokens(text: str) -> int:
+    """快速估算文本的token数：ASCII字符约4个一个token，中文等非ASCII字符约一个一个token
+
+    只用到 len 和 encode，不需要加载分词器，在上千条消息上调用也很快。
+    """
+    if not text:
+        return 0
+    length = len(text)
+    # 非ASCII字符在UTF-8中占2-4字节，大部分是3字节的中日韩字符
+    non_ascii = (len(text.encode("utf-8")) - length) // 2
+    return (length - non_ascii) // 4 + non_ascii + 1
+
+
+def estimate_message_tokens(message: Mapping[str, Any]) -> int:
+    """估算一条OpenAI格式消息的token数"""
+    tokens = MESSAGE_OVERHEAD_TOKENS
+    content = message.get("content")
+    if isinstance(content, str):
+        tokens += estimate_tokens(content)
+    elif isinstance(content, list):
+        for part in content:
+            if part.get("type") == "text":
+                tokens += estimate_tokens(part["text"])
+            elif part.get("type") == "image_url":
+                tokens += IMAGE_TOKENS
+    for tool_call in message.get("tool_calls") or ():
+        function = tool_call["function"]
+        tokens += MESSAGE_OVERHEAD_TOKENS + estimate_tokens(function["name"]) + estimate_tokens(function["arguments"])
+    return tokens
+
+
+def estimate_tools_tokens(tools: list[dict[str, Any]] | None) -> int:
+    """估算工具定义的token数"""
+    if not tools:
+        return 0
+    return estimate_tokens(json.dumps(tools, ensure_ascii=False))
+
+
+def trim_history(history: Iterable[Mapping[str, Any]], budget: int) -> tuple[list, int]:
+    """从最早的对话开始丢弃，直到历史记录的估算token数不超过budget
+
+    以user消息为边界按整轮丢弃，保证保留下来的历史仍以user消息开头，
+    assistant的工具调用和对应的tool结果不会被拆开。返回(保留的历史, 估算token数)。
+    """
+    turns: list[list] = []
+    turn_tokens: list[int] = []
+    for message in history:
+        if message["role"] == "user" or not turns:
+            turns.append([])
+            turn_tokens.append(0)
+        turns[-1].append(message)
+        turn_tokens[-1] += estimate_message_tokens(message)
+
+    total = sum(turn_tokens)
+    start = 0
+    while start < len(turns) and total > budget:
+        total -= turn_tokens[start]
+        start += 1
+    return [message for turn in turns[start:] for message in turn], total
@@ -0,0 +1,93 @@
+from collections.abc import Iterable
+import re
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from .config import ScopedConfig
+
+
+class _AnyPattern:
+    """无法安全合并成一个正则时（例如含有反向引用或全局内联标记），逐个匹配"""
+
+    def __init__(self, patterns: list[re.Pattern[str]]):
+        self.patterns = patterns
+
+    def search(self, text: str) -> bool:
+        return any(pattern.search(text) for pattern in self.patterns)
+
+
+# 按编号引用分组的语法（\1 或 (?(1)...)），合并后分组会重新编号，引用会指向错误的分组
+_NUMBERED_GROUP_REFERENCE = re.compile(r"\\[1-9]|\(\?\(\d")
+
+
+def compile_pattern(regexes: Iterable[str]) -> re.Pattern[str] | _AnyPattern | None:
+    """将多个正则合并编译成一个正则，没有任何正则时返回None
+
+    每个正则先单独编译以检查是否合法，不合法时抛出 re.error；含有按编号引用分组的语法时不合并。
+    """
+    patterns = [re.compile(regex) for regex in regexes if regex]
+    if not patterns:
+        return None
+    if len(patterns) == 1:
+        return patterns[0]
+    if any(_NUMBERED_GROUP_REFERENCE.search(pattern.pattern) for pattern in patterns):
+        return _AnyPattern(patterns)
+    try:
+        return re.compile("|".join(f"(?:{pattern.pattern})" for pattern in patterns))
+    except re.error:
+        # 例如含有全局内联标记或重名的命名分组
+        return _AnyPattern(patterns)
+
+
+class TriggerRule:
+    """编译后的触发规则
+
+    关键词和别名是普通字符串，逐个用子串查找；正则在可以安全合并时合并成一个，只扫描一遍消息。
+    """
+
+    __slots__ = ("ignore_prefixes", "keywords", "pattern")
+
+    def __init__(
+        self,
+        ignore_prefixes: Iterable[str],
+        keywords: Iterable[str],
+        nicknames: Iterable[str],
+        regexes: Iterable[str],
+    ):
+        self.ignore_prefixes = tuple(ignore_prefixes)
+        self.keywords = tuple(dict.fromkeys(keyword for keyword in (*keywords, *nicknames) if keyword))
+        self.pattern = compile_pattern(regexes)
+
+    def is_ignored(self, text: str) -> bool:
+        """消息是否以需要忽略的前缀开头"""
+        return bool(self.ignore_prefixes) and text.startswith(self.ignore_prefixes)
+
+    def matches(self, text: str) -> bool:
+        """消息是否包含触发关键词、机器人别名或匹配触发正则"""
+        for keyword in self.keywords:
+            if keyword in text:
+                return True
+        return self.pattern is not None and bool(self.pattern.search(text))
+
+
+class TriggerRules:
+    """启动时编译全局和各群的触发规则，群聊没有单独配置的项沿用全局配置"""
+
+    def __init__(self, config: "ScopedConfig"):
+        self.default = TriggerRule(
+            config.ignore_prefixes,
+            config.trigger_keywords,
+            config.trigger_nicknames,
+            config.trigger_regexes,
+        )
+        self.groups: dict[int, TriggerRule] = {}
+        for group_id, override in config.group_triggers.items():
+            self.groups[group_id] = TriggerRule(
+                config.ignore_prefixes if override.ignore_prefixes is None else override.ignore_prefixes,
+                config.trigger_keywords if override.keywords is None else override.keywords,
+                config.trigger_nicknames if override.nicknames is None else override.nicknames,
+                config.trigger_regexes if override.regexes is None else override.regexes,
+            )
+
+    def for_group(self, group_id: int) -> TriggerRule:
+        return self.groups.get(group_id, self.default)